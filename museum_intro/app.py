@@ -1,88 +1,217 @@
 import json
+from functools import partial
 from pathlib import Path
-from moviepy.editor import concatenate_videoclips, VideoFileClip, AudioFileClip
-from xtts_utils import synthesize_xtts_audio
-from t2v_utils import generate_video_clip
+from xtts_utils import synthesize_xtts_audio, preload_speaker_latents, release_xtts_model
+from t2v_utils import generate_video_clips_batch, group_clips_into_batches, release_wan_pipeline, DEFAULT_MODEL_ID, DEFAULT_NEGATIVE_PROMPT
+from render_cache import RenderCache, hash_file, make_cache_key
 from subtitle_utils import generate_ass
+from task_graph import TaskGraph
+from build_manifest import BuildManifest
+from segment_pool import split_cpu_budget
+from tracing import configure_tracing, print_trace_summary, span
+from ffmpeg_utils import concat_segments, encode_segment, LOSSLESS_CLIP_PROFILE, SEGMENT_PROFILE
 
 # Paths
 INPUT_JSON = "segments.json"
 OUTPUT_DIR = Path("generated_segments")
 OUTPUT_DIR.mkdir(exist_ok=True)
 FINAL_VIDEO = "final_output_video.mp4"
+RENDER_CACHE_DIR = "render_cache"
+RENDER_CACHE_MAX_BYTES = 20 * 1024 ** 3
+BUILD_MANIFEST = OUTPUT_DIR / "build_manifest.json"
+TRACE_PATH = OUTPUT_DIR / "trace.jsonl"
 
 VIDEO_WIDTH = 1280
 VIDEO_HEIGHT = 720
 FONT_PATH = "NotoSansSC-Regular.ttf"
+VIDEO_FPS = 16
+GUIDANCE_SCALE = 5.0
+FLOW_SHIFT = 5.0
+# Clips longer than one window are generated as overlapping windows (bounded memory), see generate_long_video_clip
+VIDEO_WINDOW_FRAMES = 81
+VIDEO_OVERLAP_FRAMES = 16
+# Cores shared by all concurrent segment encodes (default: all), split into explicit ffmpeg -threads
+RENDER_CPU_BUDGET = None
+FFMPEG_THREADS_PER_JOB = 4
+FFMPEG_JOBS, FFMPEG_THREADS = split_cpu_budget(RENDER_CPU_BUDGET, threads_per_job=FFMPEG_THREADS_PER_JOB)
+# Concurrent tasks per resource pool in generate_from_json
+POOL_LIMITS = {"diffusion": 1, "tts": 1, "subtitle": 2, "ffmpeg": FFMPEG_JOBS}
 # Speaker WAVs (must exist)
 SPEAKER_MAP = {
     "speak_0": "voices/speak_0.wav",
     "speak_1": "voices/speak_1.wav"
 }
 
-def generate_from_json(json_path):
+def generate_and_cache_clips(clips, render_cache, manifest):
+    generate_video_clips_batch(clips, height=VIDEO_HEIGHT, width=VIDEO_WIDTH, fps=VIDEO_FPS,
+                               guidance_scale=GUIDANCE_SCALE, flow_shift=FLOW_SHIFT,
+                               batch_size=len(clips), writer_kwargs=LOSSLESS_CLIP_PROFILE,
+                               window_frames=VIDEO_WINDOW_FRAMES, overlap_frames=VIDEO_OVERLAP_FRAMES)
+    for clip in clips:
+        render_cache.store(clip["cache_key"], clip["video_path"])
+        manifest.record(clip["video_path"], {"cache_key": clip["cache_key"]})
+
+def build_step(manifest, artifact, inputs, fn):
+    """Wraps fn so the artifact is recorded in the manifest once fn succeeds."""
+    def run():
+        result = fn()
+        manifest.record(artifact, inputs)
+        return result
+    return run
+
+def generate_from_json(json_path, video_batch_size=4, manifest=None):
+    """
+    Builds every final segment of the script, regenerating only artifacts
+    whose inputs changed since the last run (see BuildManifest).
+    """
     with open(json_path, "r", encoding="utf-8") as f:
         segments = json.load(f)
+    manifest = manifest or BuildManifest(BUILD_MANIFEST)
+
+    # Serve unchanged clips from the manifest or the render cache
+    render_cache = RenderCache(RENDER_CACHE_DIR, max_bytes=RENDER_CACHE_MAX_BYTES)
+    pending_clips = []
+    video_fingerprints = {}
+    with span("plan_cached_clips", segments=len(segments)):
+        for seg in segments:
+            clip = {
+                "prompt": seg["description"],
+                "negative_prompt": seg.get("negative_prompt", ""),
+                "duration": seg["duration"],
+                "seed": seg.get("seed", seg["segment_id"]),
+                "video_path": str(OUTPUT_DIR / f"segment_{seg['segment_id']}.mp4"),
+            }
+            num_frames = int(clip["duration"] * VIDEO_FPS)
+            # Windowed generation changes the output, so the window settings are part of long clips' keys
+            windowing = ({"windows": (VIDEO_WINDOW_FRAMES, VIDEO_OVERLAP_FRAMES)}
+                         if num_frames > VIDEO_WINDOW_FRAMES else {})
+            clip["cache_key"] = make_cache_key(
+                prompt=clip["prompt"],
+                negative_prompt=clip["negative_prompt"] or DEFAULT_NEGATIVE_PROMPT,
+                model_id=DEFAULT_MODEL_ID,
+                resolution=(VIDEO_WIDTH, VIDEO_HEIGHT),
+                fps=VIDEO_FPS,
+                num_frames=num_frames,
+                guidance_scale=GUIDANCE_SCALE,
+                flow_shift=FLOW_SHIFT,
+                seed=clip["seed"],
+                encoding=LOSSLESS_CLIP_PROFILE,
+                **windowing,
+            )
+            video_inputs = {"cache_key": clip["cache_key"]}
+            video_fingerprints[clip["video_path"]] = BuildManifest.fingerprint(video_inputs)
+            if not manifest.is_stale(clip["video_path"], video_inputs):
+                continue
+            if render_cache.fetch(clip["cache_key"], clip["video_path"]):
+                manifest.record(clip["video_path"], video_inputs)
+            else:
+                # Break any hardlink to an older cache entry before regenerating
+                Path(clip["video_path"]).unlink(missing_ok=True)
+                pending_clips.append(clip)
+
+    # Each segment is video -> mux <- TTS, ASS; independent stages run concurrently per pool
+    graph = TaskGraph(POOL_LIMITS)
+
+    video_tasks = {}
+    batches = group_clips_into_batches(pending_clips, VIDEO_HEIGHT, VIDEO_WIDTH, VIDEO_FPS, video_batch_size)
+    for batch_index, batch in enumerate(batches):
+        task = graph.add(f"video_batch_{batch_index}", partial(generate_and_cache_clips, batch, render_cache, manifest),
+                         pool="diffusion")
+        for clip in batch:
+            video_tasks[clip["video_path"]] = task
+    if batches:
+        # Free the resident Wan pipeline once every clip is rendered
+        graph.add("release_wan", release_wan_pipeline, deps=sorted(set(video_tasks.values())), pool="diffusion")
+    print(f"\n🎬 Generating {len(pending_clips)} of {len(segments)} video clips in {len(batches)} batches...")
+
+    # Speaker latents are computed once per voice (and cached on disk)
+    speaker_hashes = {speaker: hash_file(wav) for speaker, wav in SPEAKER_MAP.items()}
+    latents_task = None
+    tts_tasks = []
 
     segment_paths = []
 
-    for i, seg in enumerate(segments):
+    for seg in segments:
         seg_id = seg["segment_id"]
-        prompt = seg["description"]
         narration = seg["narration"]
         speaker = seg["speak_id"]
         duration = seg["duration"]
 
-        print(f"\n🎬 Segment {seg_id}: Generating video and audio...")
-
-        # Generate video
         video_path = OUTPUT_DIR / f"segment_{seg_id}.mp4"
-        generate_video_clip(prompt, duration, str(video_path))
+        audio_path = OUTPUT_DIR / f"segment_{seg_id}.wav"
+        ass_path = OUTPUT_DIR / f"segment_{seg_id}.ass"
+        final_segment = OUTPUT_DIR / f"final_segment_{seg_id}.mp4"
 
         # Generate TTS
-        audio_path = OUTPUT_DIR / f"segment_{seg_id}.wav"
-        synthesize_xtts_audio(
-            text=narration,
-            speaker_wav=SPEAKER_MAP[speaker],
-            output_path=str(audio_path)
-        )
+        tts_inputs = {"narration": narration, "speaker_wav": speaker_hashes[speaker]}
+        tts_task = None
+        if manifest.is_stale(audio_path, tts_inputs):
+            if latents_task is None:
+                latents_task = graph.add("speaker_latents", partial(preload_speaker_latents, SPEAKER_MAP.values()), pool="tts")
+            tts_task = graph.add(f"tts_{seg_id}", build_step(manifest, audio_path, tts_inputs, partial(
+                synthesize_xtts_audio,
+                full_text=narration,
+                speaker_wav_path=SPEAKER_MAP[speaker],
+                output_audio_path=str(audio_path)
+            )), deps=[latents_task], pool="tts")
+            tts_tasks.append(tts_task)
 
         # Overlay subtitle
-        ass_path = OUTPUT_DIR / f"segment_{seg_id}.ass"
-        generate_ass(text=narration, duration=duration, output_path=ass_path, 
-                     video_width=VIDEO_WIDTH, video_height=VIDEO_HEIGHT, font_path=FONT_PATH)
+        ass_inputs = {"narration": narration, "duration": duration, "resolution": (VIDEO_WIDTH, VIDEO_HEIGHT),
+                      "font": FONT_PATH}
+        ass_task = None
+        if manifest.is_stale(ass_path, ass_inputs):
+            ass_task = graph.add(f"ass_{seg_id}", build_step(manifest, ass_path, ass_inputs, partial(
+                generate_ass, text=narration, duration=duration, output_path=ass_path,
+                video_width=VIDEO_WIDTH, video_height=VIDEO_HEIGHT, font_path=FONT_PATH
+            )), pool="subtitle")
 
         # Combine video + audio + subtitle (via ffmpeg wrapper)
-        final_segment = OUTPUT_DIR / f"final_segment_{seg_id}.mp4"
-        mux_segment_with_audio_and_subtitles(
-            str(video_path), str(audio_path), str(ass_path), str(final_segment)
-        )
+        mux_inputs = {
+            "video": video_fingerprints[str(video_path)],
+            "audio": BuildManifest.fingerprint(tts_inputs),
+            "subtitle": BuildManifest.fingerprint(ass_inputs),
+            "profile": SEGMENT_PROFILE,
+        }
+        if manifest.is_stale(final_segment, mux_inputs):
+            mux_deps = [task for task in (tts_task, ass_task, video_tasks.get(str(video_path))) if task]
+            graph.add(f"mux_{seg_id}", build_step(manifest, final_segment, mux_inputs, partial(
+                mux_segment_with_audio_and_subtitles,
+                str(video_path), str(audio_path), str(ass_path), str(final_segment)
+            )), deps=mux_deps, pool="ffmpeg")
 
         segment_paths.append(str(final_segment))
 
+    if tts_tasks:
+        # Free the resident XTTS model once every narration is synthesized
+        graph.add("release_xtts", release_xtts_model, deps=tts_tasks, pool="tts")
+
+    with span("task_graph", tasks=len(graph.tasks)):
+        graph.run()
+    print(f"Render cache: {render_cache.stats()}")
     return segment_paths
 
 def stitch_segments(segment_paths, output_path):
-    clips = [VideoFileClip(p) for p in segment_paths]
-    final = concatenate_videoclips(clips)
-    final.write_videofile(output_path, codec="libx264", audio_codec="aac")
+    # Stream-copies matching segments; only mismatched ones are re-encoded
+    with span("stitch", segments=len(segment_paths)):
+        concat_segments(segment_paths, output_path, work_dir=str(OUTPUT_DIR))
     print(f"\n✅ Final video saved to {output_path}")
 
-# FFmpeg mux wrapper
+# FFmpeg mux wrapper: the lossless clip, audio and subtitles go through one filter graph and
+# one encode in the shared segment profile, so stitch_segments can stream-copy the result
 def mux_segment_with_audio_and_subtitles(video, audio, srt, output):
-    import subprocess
-    subprocess.run([
-        "ffmpeg", "-y",
-        "-i", video,
-        "-i", audio,
-        "-vf", f"subtitles={srt}",
-        "-shortest",
-        "-c:v", "libx264",
-        "-c:a", "aac",
-        output
-    ], check=True)
+    encode_segment(video, output, audio_path=audio, subtitle_path=srt, fps=VIDEO_FPS, threads=FFMPEG_THREADS)
 
 
 if __name__ == "__main__":
-    segment_paths = generate_from_json(INPUT_JSON)
-    stitch_segments(segment_paths, FINAL_VIDEO)
+    configure_tracing(TRACE_PATH)
+    manifest = BuildManifest(BUILD_MANIFEST)
+    with span("app_run"):
+        segment_paths = generate_from_json(INPUT_JSON, manifest=manifest)
+        final_inputs = {"segments": [manifest.fingerprint({"path": p, "size": Path(p).stat().st_size, "sha256": hash_file(p)})
+                                     for p in segment_paths]}
+        if manifest.is_stale(FINAL_VIDEO, final_inputs):
+            stitch_segments(segment_paths, FINAL_VIDEO)
+            manifest.record(FINAL_VIDEO, final_inputs)
+    manifest.report()
+    print_trace_summary()
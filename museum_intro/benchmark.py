@@ -0,0 +1,347 @@
+"""
+Offline throughput benchmark for the museum pipeline.
+
+Runs the real orchestration code (task graph, build manifest, caches, ffmpeg
+encodes, subtitle generation and stitching) on a synthetic script, with the
+models replaced by deterministic stand-ins: block-noise frames instead of
+Wan, sine tones instead of XTTS, LocalStubBackend instead of OpenAI and
+tiny generated images instead of SD keyframes. The keyframe stage runs the
+real keyframe_utils.generate_all_keyframe_images (prompt prefetching, rate
+limiting, prompt store, image saving). Only ffmpeg (and the packages the
+pipeline imports for audio/subtitles) has to be installed.
+
+    python benchmark.py --segments 12 --seconds 4 --width 320 --height 180
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import zlib
+from pathlib import Path
+
+# Appended, so the top-level keyframe_utils.py wins over utils/keyframe_utils.py
+UTILS_DIR = Path(__file__).resolve().parent / "utils"
+if str(UTILS_DIR) not in sys.path:
+    sys.path.append(str(UTILS_DIR))
+
+import numpy as np
+import soundfile as sf
+
+from tracing import configure_tracing, print_trace_summary, span
+
+STUB_SAMPLE_RATE = 24000  # XTTS output rate
+SPEAKERS = ["太阳人", "博小翼"]
+PHRASES = ["欢迎来到博物馆", "这件文物距今已有五千年历史", "请跟随我的讲解", "你看它的纹饰", "AI导览正在为您服务",
+           "Welcome to the night museum", "this carving shows the sun god", "let me tell you its story"]
+
+
+# ----------------------------
+# Synthetic inputs
+# ----------------------------
+def synthetic_script(num_segments: int, seconds: float, seed: int = 0) -> list:
+    """Deterministic segments carrying the fields app.py, orchestrator_staticVideo and the subtitle tools read."""
+    rng = random.Random(seed)
+    segments = []
+    start = 0.0
+    for segment_id in range(1, num_segments + 1):
+        lines = []
+        for _ in range(rng.randint(1, 3)):
+            speaker = rng.choice(SPEAKERS)
+            lines.append(f"{speaker}: {'，'.join(rng.choice(PHRASES) for _ in range(rng.randint(1, 3)))}")
+        narration = "\n".join(lines)
+        segments.append({
+            "segment_id": segment_id,
+            "description": f"Scene {segment_id}: {rng.choice(PHRASES)}",
+            "speaker": lines[0].split(":")[0],
+            "speak_id": f"speak_{segment_id % 2}",
+            "narration": narration,
+            "duration": seconds,
+            "start": start,
+            "end": start + seconds,
+            "original": narration.replace("\n", " "),
+        })
+        start += seconds
+    return segments
+
+
+def write_png(path, width: int, height: int, seed: int = 0):
+    """Writes a tiny RGB gradient PNG with numpy and zlib only."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    base = rng.integers(0, 256, 3)
+    pixels = ((base + np.stack([x * 255 // max(1, width - 1), y * 255 // max(1, height - 1),
+                                (x + y) * 127 // max(1, width + height)], axis=-1)) % 256).astype(np.uint8)
+    raw = b"".join(b"\x00" + row.tobytes() for row in pixels)
+
+    def chunk(tag, data):
+        return (len(data).to_bytes(4, "big") + tag + data
+                + zlib.crc32(tag + data).to_bytes(4, "big"))
+
+    header = width.to_bytes(4, "big") + height.to_bytes(4, "big") + bytes([8, 2, 0, 0, 0])
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, 1))
+                + chunk(b"IEND", b""))
+
+
+def sine_tone(text: str, speaker_key: str, sample_rate: int = STUB_SAMPLE_RATE) -> np.ndarray:
+    """Speech stand-in: a tone whose length follows the text (~0.12s per character)."""
+    duration = 0.3 + 0.12 * len(text)
+    frequency = 180 + zlib.crc32(speaker_key.encode("utf-8")) % 200
+    t = np.arange(int(duration * sample_rate), dtype=np.float32) / sample_rate
+    return (0.3 * np.sin(2 * np.pi * frequency * t)).astype(np.float32)
+
+
+def noise_frames(num_frames: int, height: int, width: int, seed: int = 0, block: int = 8):
+    """Video stand-in: drifting block noise, which compresses more like real footage than per-pixel noise."""
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 256, (-(-height // block) + 1, -(-width // block) + 1, 3), dtype=np.uint8)
+    for index in range(num_frames):
+        shifted = np.roll(small, index % small.shape[1], axis=1)
+        frame = np.repeat(np.repeat(shifted, block, axis=0), block, axis=1)[:height, :width]
+        yield frame
+
+
+# ----------------------------
+# Stand-in model modules
+# ----------------------------
+class StubImage:
+    """Stands in for a PIL image returned by an SD pipeline; save() writes a gradient PNG."""
+
+    def __init__(self, width: int, height: int, seed: int):
+        self.size = (width, height)
+        self.seed = seed
+
+    def save(self, path):
+        write_png(path, self.size[0], self.size[1], self.seed)
+
+
+class StubSDPipeline:
+    """SD stand-in: one StubImage per requested image, seeded from the per-image generators."""
+
+    def __call__(self, num_images_per_prompt=1, generator=None, height=256, width=256, **_):
+        seeds = generator if isinstance(generator, list) else [0] * num_images_per_prompt
+        with span("sd_denoise", images=num_images_per_prompt):
+            return types.SimpleNamespace(images=[StubImage(width, height, seed) for seed in seeds])
+
+
+def install_stub_models():
+    """
+    Swaps the model-bound parts of t2v_utils, sd_pipeline_utils and
+    xtts_utils for stand-ins before the orchestrators import them, keeping
+    the function signatures they call. t2v_utils imports torch lazily, so
+    its real batching helpers are used as they are.
+    """
+    import t2v_utils as t2v
+    from ffmpeg_utils import segment_writer_kwargs, stream_frames_to_video
+
+    def generate_video_clip(prompt, duration, video_path, height=720, width=1280, fps=16,
+                            codec="libx264", crf=18, audio_path=None, subtitle_path=None, seed=0, **_):
+        num_frames = int(duration * fps)
+        if audio_path or subtitle_path:
+            writer_kwargs = segment_writer_kwargs(audio_path, subtitle_path, num_frames / fps)
+        else:
+            writer_kwargs = {"codec": codec, "crf": crf}
+        with span("encode_clip", frames=num_frames):
+            return stream_frames_to_video(noise_frames(num_frames, height, width, seed), video_path, fps,
+                                          **writer_kwargs)
+
+    def generate_video_clips_batch(clips, height=720, width=1280, fps=16, codec="libx264", crf=18,
+                                   batch_size=4, writer_kwargs=None, **_):
+        writer_kwargs = dict({"codec": codec, "crf": crf}, **(writer_kwargs or {}))
+        for batch in t2v.group_clips_into_batches(clips, height, width, fps, batch_size):
+            for clip in batch:
+                num_frames = int(clip["duration"] * fps)
+                frames = noise_frames(num_frames, clip.get("height", height), clip.get("width", width),
+                                      clip.get("seed") or 0)
+                with span("encode_clip", frames=num_frames):
+                    stream_frames_to_video(frames, clip["video_path"], fps, **writer_kwargs)
+        return [clip["video_path"] for clip in clips]
+
+    t2v.generate_video_clip = generate_video_clip
+    t2v.generate_video_clips_batch = generate_video_clips_batch
+    t2v.release_wan_pipeline = lambda *args, **kwargs: 0
+
+    sd = types.ModuleType("sd_pipeline_utils")
+    sd_pipe = StubSDPipeline()
+    sd.get_txt2img_pipeline = lambda *args, **kwargs: sd_pipe
+    sd.get_img2img_pipeline = lambda *args, **kwargs: sd_pipe
+    sd.make_generators = lambda seeds, device="cpu": [int(seed) for seed in seeds]
+    sd.get_prompt_embeds = lambda pipe, model_id, prompt, negative_prompt="": {}
+    sd.get_reference_latents = lambda pipe, model_id, image_path, resolution: None
+    sd.release_sd_pipelines = lambda: None
+    sys.modules["sd_pipeline_utils"] = sd
+
+    xtts = types.ModuleType("xtts_utils")
+
+    def synthesize_xtts_audio(full_text, speaker_wav_path, output_audio_path, target_language="zh-cn", speed=1.0):
+        with span("xtts_synthesize", chars=len(full_text)):
+            sf.write(output_audio_path, sine_tone(full_text, str(speaker_wav_path)), STUB_SAMPLE_RATE)
+
+    def synthesize_lines_batch(lines, batch_size=8, num_workers=0, torch_threads=None):
+        results = []
+        for line in lines:
+            with span("xtts_synthesize", chars=len(line["text"])):
+                samples = sine_tone(line["text"], str(line.get("speaker") or line["speaker_wav"]))
+            results.append({**line, "samples": samples, "sample_rate": STUB_SAMPLE_RATE,
+                            "duration": len(samples) / STUB_SAMPLE_RATE})
+        return results
+
+    xtts.synthesize_xtts_audio = synthesize_xtts_audio
+    xtts.synthesize_lines_batch = synthesize_lines_batch
+    xtts.preload_speaker_latents = lambda paths: None
+    xtts.release_xtts_model = lambda: None
+    sys.modules["xtts_utils"] = xtts
+
+
+# ----------------------------
+# Stages
+# ----------------------------
+def bench_keyframes(segments, workdir: Path, latency: float, concurrency: int):
+    """keyframe_utils.generate_all_keyframe_images with the stub chat backend and stub SD pipeline."""
+    # The chat backend is picked from the environment when keyframe_utils is imported
+    os.environ["PROMPT_BACKEND"] = "stub"
+    os.environ["PROMPT_STUB_LATENCY"] = str(latency)
+    import keyframe_utils
+    from llm_utils import RateLimiter
+
+    keyframe_utils.PROMPT_CONCURRENCY = concurrency
+    keyframe_utils.PROMPT_RATE_LIMITER = RateLimiter(requests_per_minute=10_000, tokens_per_minute=10_000_000)
+    return keyframe_utils.generate_all_keyframe_images(segments, output_dir=str(workdir / "keyframes"))
+
+
+def bench_subtitles(segments, workdir: Path, width: int, height: int, font_path: str):
+    from subtitle_utils import generate_srt_ass_file
+    generate_srt_ass_file(iter(segments), str(workdir / "bench.srt"), str(workdir / "bench.ass"),
+                          width, height, font_path, vtt_output_path=str(workdir / "bench.vtt"))
+
+
+def bench_static_video(segments, workdir: Path, width: int, height: int, cpu_budget: int):
+    """orchestrator_staticVideo end to end: line TTS, audio assembly, still-image encodes, concat."""
+    import orchestrator_staticVideo as static
+
+    for segment in segments:
+        image_path = workdir / f"Final_segment_{segment['segment_id']}.png"
+        if not image_path.exists():
+            write_png(image_path, width, height, seed=segment["segment_id"])
+    sample_path = Path(static.OUTPUT_DIR) / "speaker_sample.wav"
+    if not sample_path.exists():
+        sf.write(sample_path, sine_tone("speaker sample", "sample"), STUB_SAMPLE_RATE)
+    static.RENDER_CPU_BUDGET = cpu_budget
+    static.generate_full_video(segments)
+    return static.FINAL_VIDEO
+
+
+def bench_app(segments, workdir: Path, width: int, height: int, fps: int, cpu_budget: int):
+    """app.py end to end: task graph over noise clips, TTS, ASS, single-pass mux and stream-copy stitch."""
+    import app
+    from segment_pool import split_cpu_budget
+
+    for speaker_wav in app.SPEAKER_MAP.values():
+        Path(speaker_wav).parent.mkdir(parents=True, exist_ok=True)
+        if not Path(speaker_wav).exists():
+            sf.write(speaker_wav, sine_tone("speaker sample", speaker_wav), STUB_SAMPLE_RATE)
+    app.VIDEO_WIDTH, app.VIDEO_HEIGHT, app.VIDEO_FPS = width, height, fps
+    app.FFMPEG_JOBS, app.FFMPEG_THREADS = split_cpu_budget(cpu_budget, threads_per_job=app.FFMPEG_THREADS_PER_JOB)
+    app.POOL_LIMITS["ffmpeg"] = app.FFMPEG_JOBS
+
+    script_path = workdir / "segments.json"
+    with open(script_path, "w", encoding="utf-8") as f:
+        json.dump(segments, f, ensure_ascii=False)
+    segment_paths = app.generate_from_json(str(script_path))
+    app.stitch_segments(segment_paths, app.FINAL_VIDEO)
+    return app.FINAL_VIDEO
+
+
+def bench_burn_in(video_path: str, workdir: Path, font_path: str):
+    from subtitle_utils import burn_in_subtitles
+    burn_in_subtitles(video_path, str(workdir / "bench.ass"), str(workdir / "bench_burned.mp4"), font_path,
+                      smart_render=True)
+
+
+# ----------------------------
+# Runner
+# ----------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--segments", type=int, default=8, help="segments in the synthetic script")
+    parser.add_argument("--seconds", type=float, default=4.0, help="duration of each segment")
+    parser.add_argument("--width", type=int, default=320)
+    parser.add_argument("--height", type=int, default=180)
+    parser.add_argument("--fps", type=int, default=16)
+    parser.add_argument("--cpu-budget", type=int, default=None, help="cores for concurrent ffmpeg encodes")
+    parser.add_argument("--prompt-latency", type=float, default=0.05, help="fake chat client latency (s)")
+    parser.add_argument("--prompt-concurrency", type=int, default=4)
+    parser.add_argument("--font", default="NotoSansSC-Regular.ttf")
+    parser.add_argument("--stages", default="keyframes,subtitles,static_video,app,burn_in")
+    parser.add_argument("--rerun", action="store_true", help="run every stage a second time to time warm caches")
+    parser.add_argument("--workdir", default=None, help="keep outputs here instead of a temp dir")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None:
+        sys.exit("ffmpeg and ffprobe must be on PATH")
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="museum_bench_")).resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+    font_path = str(Path(args.font).resolve())
+    # The orchestrators resolve their output paths relative to the working directory
+    os.chdir(workdir)
+    configure_tracing(workdir / "trace.jsonl")
+    install_stub_models()
+
+    segments = synthetic_script(args.segments, args.seconds, args.seed)
+    video_seconds = args.segments * args.seconds
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    outputs = {}
+
+    def run_stage(name):
+        if name == "keyframes":
+            return bench_keyframes(segments, workdir, args.prompt_latency, args.prompt_concurrency)
+        if name == "subtitles":
+            return bench_subtitles(segments, workdir, args.width, args.height, font_path)
+        if name == "static_video":
+            outputs["video"] = bench_static_video(segments, workdir, args.width, args.height, args.cpu_budget)
+            return outputs["video"]
+        if name == "app":
+            outputs["video"] = bench_app(segments, workdir, args.width, args.height, args.fps, args.cpu_budget)
+            return outputs["video"]
+        if name == "burn_in":
+            if not os.path.exists(font_path):
+                raise FileNotFoundError(f"burn-in needs a font file, {font_path} not found")
+            if "video" not in outputs:
+                raise RuntimeError("burn-in needs the output of static_video or app")
+            return bench_burn_in(outputs["video"], workdir, font_path)
+        raise ValueError(f"Unknown stage: {name}")
+
+    rows = []
+    run_start = time.perf_counter()
+    with span("bench_run", segments=args.segments):
+        for warm in [False, True] if args.rerun else [False]:
+            for name in stages:
+                start = time.perf_counter()
+                status = "ok"
+                try:
+                    with span(f"bench.{name}" + ("_warm" if warm else "")):
+                        run_stage(name)
+                except (ImportError, FileNotFoundError, RuntimeError, subprocess.CalledProcessError) as e:
+                    status = f"failed: {e}"
+                rows.append((name + (" (warm)" if warm else ""), time.perf_counter() - start, status))
+    total = time.perf_counter() - run_start
+
+    print(f"\n📊 Benchmark: {args.segments} segments x {args.seconds}s at {args.width}x{args.height}, "
+          f"{args.fps} fps (workdir {workdir})")
+    print(f"{'stage':<24} {'wall s':>8} {'seg/s':>8} {'x realtime':>11}  status")
+    for name, elapsed, status in rows:
+        print(f"{name:<24} {elapsed:>8.2f} {args.segments / elapsed:>8.2f} {video_seconds / elapsed:>11.2f}  {status}")
+    print(f"{'end to end':<24} {total:>8.2f} {args.segments / total:>8.2f} {video_seconds / total:>11.2f}")
+    print_trace_summary()
+
+
+if __name__ == "__main__":
+    main()
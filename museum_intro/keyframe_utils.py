@@ -1,24 +1,47 @@
+import asyncio
 import os
 import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from diffusers import StableDiffusionPipeline, StableDiffusionImg2ImgPipeline
-import torch
-from PIL import Image
-from openai import OpenAI
 
-client = OpenAI()
+# Helpers in utils/ import each other flat, like app.py and the orchestrators do
+UTILS_DIR = Path(__file__).resolve().parent / "utils"
+if str(UTILS_DIR) not in sys.path:
+    sys.path.append(str(UTILS_DIR))
+
+from sd_pipeline_utils import get_txt2img_pipeline, get_img2img_pipeline, make_generators, get_prompt_embeds, get_reference_latents
+from prompt_store import PromptStore
+from llm_utils import get_prompt_backend, RateLimiter, complete_with_retries, PromptPrefetcher
+from tracing import span
+
+# Chat backend for keyframe prompts (PROMPT_BACKEND=stub runs offline), with bounded
+# concurrency and request/token rate limits
+PROMPT_BACKEND = get_prompt_backend()
+PROMPT_CONCURRENCY = 4
+PROMPT_RATE_LIMITER = RateLimiter(requests_per_minute=60, tokens_per_minute=90_000)
 
 # Global story context
 story_context_cn = "《博物馆的全能ACE》是一部拟人化博物馆文物与AI讲解助手互动的短片，讲述太阳人石刻在闭馆后的博物馆中，遇到了新来的AI助手博小翼，两者展开对话，AI展示了自己的多模态讲解能力与文化知识，最终被文物们认可，并一起展开智慧导览服务的故事。该片融合了文物拟人化、夜间博物馆奇妙氛围、科技感界面与中国地方文化元素，风格活泼、具未来感。"
 
-# Cache and log directories
-CACHE_DIR = Path("prompt_cache")
-CACHE_DIR.mkdir(exist_ok=True)
+# Prompt cache: one append-only log indexed by a hash of the prompt inputs
 LOG_PATH = Path("prompt_log.jsonl")
+PROMPT_STORE = PromptStore(LOG_PATH)
+PROMPT_TEMPERATURE = 0.7
+
+# Pipelines, loaded lazily on first use (diffusers is imported only then); img2img shares the txt2img weights
+SD_MODEL_ID = "CompVis/stable-diffusion-v1-4"
+
+def get_pipe_txt2img():
+    return get_txt2img_pipeline("StableDiffusionPipeline", SD_MODEL_ID, torch_dtype="float16", device="cpu")
+
+def get_pipe_img2img():
+    return get_img2img_pipeline("StableDiffusionImg2ImgPipeline", "StableDiffusionPipeline", SD_MODEL_ID, torch_dtype="float16", device="cpu")
 
-# Pipelines
-pipe_txt2img = StableDiffusionPipeline.from_pretrained("CompVis/stable-diffusion-v1-4", torch_dtype=torch.float16).to("cpu")
-pipe_img2img = StableDiffusionImg2ImgPipeline.from_pretrained("CompVis/stable-diffusion-v1-4", torch_dtype=torch.float16).to("cpu")
+# Keyframe variants per segment; variant i of segment s is seeded with
+# KEYFRAME_BASE_SEED + s * 1000 + i so any variant can be regenerated exactly
+NUM_KEYFRAME_VARIANTS = 3
+KEYFRAME_BASE_SEED = 20240
 
 # Reference image context for characters
 REFERENCE_CONTEXT = "参考角色视觉信息：'太阳人石刻' 是带有放射状头饰、佩戴墨镜的新石器时代人物形象，风格庄严中略带潮流感。图像见 assets/sunman.png。'博小翼' 是一个圆头圆眼、漂浮型的可爱AI机器人助手，风格拟人、语气亲切，图像见 assets/boxiaoyi.png。"
@@ -30,28 +53,50 @@ ASSET_IMAGES = {
 }
 
 def generate_keyframe_prompt(segment):
+    return asyncio.run(generate_keyframe_prompt_async(segment))
+
+def prompt_cache_key(segment, backend=None):
+    """PROMPT_STORE key of a segment: a hash of every input that shapes its prompt."""
+    return PromptStore.key_for(
+        story_context=story_context_cn,
+        description=segment.get("description", ""),
+        speaker=segment.get("speaker", ""),
+        narration=segment.get("narration", ""),
+        reference_context=REFERENCE_CONTEXT,
+        model=(backend or PROMPT_BACKEND).model,
+        image_model=SD_MODEL_ID,
+        temperature=PROMPT_TEMPERATURE
+    )
+
+def compact_prompt_store(script_data, backend=None):
+    """Drops cached prompts of segments that were edited or removed from script_data."""
+    PROMPT_STORE.compact(keep={prompt_cache_key(segment, backend) for segment in script_data})
+
+async def generate_keyframe_prompt_async(segment, backend=None, limiter=None):
     segment_id = segment.get("segment_id")
-    cache_file = CACHE_DIR / f"segment_{segment_id}.json"
-    if cache_file.exists():
-        with open(cache_file, "r", encoding="utf-8") as f:
-            return json.load(f)
-
     description = segment.get("description", "")
     speaker = segment.get("speaker", "")
     narration = segment.get("narration", "")
+    backend = backend or PROMPT_BACKEND
+
+    cache_key = prompt_cache_key(segment, backend)
+    cached = PROMPT_STORE.get(cache_key)
+    if cached is not None:
+        return {"prompt": cached["prompt"], "negative_prompt": cached["negative_prompt"]}
 
     input_prompt = f"你是一个擅长视觉脚本设计的AI，请基于以下故事整体背景与分镜内容，帮我生成一个适合用于Stable Diffusion图像生成的英文提示词（image prompt），用于生成低分辨率草图风格的关键帧。请注意突出主要角色、镜头氛围、光影、构图、动作，避免复杂背景和细节。提示词长度不应超过80词，以防止超出Stable Diffusion的token限制。\n\n【整体故事背景】：\n{story_context_cn}\n\n【当前分镜描述】：\n{description}\n【角色】：{speaker}\n【台词或画外音】：{narration}\n\n{REFERENCE_CONTEXT}\n\n请用英文输出一个简洁但具体的prompt，风格偏草图、线稿、卡通、简洁构图，并指出一个negative prompt。"
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "You are an expert visual prompt designer for image generation."},
-                {"role": "user", "content": input_prompt}
-            ],
-            temperature=0.7
-        )
-        output_text = response.choices[0].message.content
+        with span("keyframe_prompt", segment_id=segment_id, model=backend.model):
+            output_text = await complete_with_retries(
+                backend,
+                [
+                    {"role": "system", "content": "You are an expert visual prompt designer for image generation."},
+                    {"role": "user", "content": input_prompt}
+                ],
+                temperature=PROMPT_TEMPERATURE,
+                limiter=limiter
+            )
         if "Negative prompt:" in output_text:
             prompt, negative = output_text.split("Negative prompt:", 1)
         else:
@@ -61,10 +106,7 @@ def generate_keyframe_prompt(segment):
             "prompt": prompt.strip(),
             "negative_prompt": negative.strip()
         }
-        with open(cache_file, "w", encoding="utf-8") as f:
-            json.dump(result, f, ensure_ascii=False, indent=2)
-        with open(LOG_PATH, "a", encoding="utf-8") as logf:
-            logf.write(json.dumps({"segment_id": segment_id, **result}, ensure_ascii=False) + "\n")
+        PROMPT_STORE.put(cache_key, {"segment_id": segment_id, **result})
         return result
     except Exception as e:
         print(f"[Error] GPT-4o prompt generation failed for segment {segment_id}: {e}")
@@ -73,42 +115,87 @@ def generate_keyframe_prompt(segment):
             "negative_prompt": ""
         }
 
+def keyframe_variant_seeds(segment_id, num_variants=NUM_KEYFRAME_VARIANTS):
+    return [KEYFRAME_BASE_SEED + int(segment_id) * 1000 + i for i in range(num_variants)]
+
+def render_keyframe_variants(prompt, negative_prompt, seeds, reference_path=None):
+    """
+    Renders one image per seed in a single pipeline call. Prompt embeddings
+    and reference latents come from the on-disk tensor cache, so the text
+    encoder and VAE encoder only run for prompts/assets not seen before.
+    """
+    generators = make_generators(seeds)
+    if reference_path is not None:
+        pipe = get_pipe_img2img()
+        init_latents = get_reference_latents(pipe, SD_MODEL_ID, reference_path, (512, 512))
+        return pipe(image=init_latents, strength=0.6, guidance_scale=7.5,
+                    num_images_per_prompt=len(seeds), generator=generators,
+                    **get_prompt_embeds(pipe, SD_MODEL_ID, prompt, negative_prompt)).images
+    pipe = get_pipe_txt2img()
+    return pipe(num_inference_steps=20, guidance_scale=7.5, height=256, width=256,
+                num_images_per_prompt=len(seeds), generator=generators,
+                **get_prompt_embeds(pipe, SD_MODEL_ID, prompt, negative_prompt)).images
+
+def reference_image_path(description):
+    """Returns the reference asset for the first character named in description, or None."""
+    ref_key = next((k for k in ASSET_IMAGES if k in description), None)
+    return ASSET_IMAGES[ref_key] if ref_key is not None else None
+
+def regenerate_keyframe_variant(keyframe_output, variant_index, output_path, description=""):
+    """Re-renders one variant from an all_prompts_output.json entry using its recorded seed."""
+    seed = keyframe_output["seeds"][variant_index]
+    image = render_keyframe_variants(keyframe_output["prompt"], keyframe_output["negative_prompt"], [seed],
+                                     reference_path=reference_image_path(description))[0]
+    image.save(output_path)
+    return output_path
+
 def generate_all_keyframe_images(script_data, output_dir="keyframes"):
     os.makedirs(output_dir, exist_ok=True)
     keyframe_outputs = []
-
-    for segment in script_data:
-        sd_prompts = generate_keyframe_prompt(segment)
-        prompt = sd_prompts["prompt"]
-        negative_prompt = sd_prompts["negative_prompt"]
-        segment_id = segment.get("segment_id")
-
-        description = segment.get("description", "")
-        use_reference = any(name in description for name in ASSET_IMAGES)
-
-        if use_reference:
-            ref_key = next(k for k in ASSET_IMAGES if k in description)
-            init_image = Image.open(ASSET_IMAGES[ref_key]).convert("RGB").resize((512, 512))
-
-        frame_images = []
-        for i in range(3):
-            if use_reference:
-                image = pipe_img2img(prompt=prompt, image=init_image, negative_prompt=negative_prompt, strength=0.6, guidance_scale=7.5).images[0]
-            else:
-                image = pipe_txt2img(prompt, negative_prompt=negative_prompt, num_inference_steps=20, guidance_scale=7.5, height=256, width=256).images[0]
-
-            image_path = os.path.join(output_dir, f"segment_{segment_id}_v{i+1}.png")
-            image.save(image_path)
-            frame_images.append(image_path)
-
-        keyframe_outputs.append({
-            "segment_id": segment_id,
-            "prompt": prompt,
-            "negative_prompt": negative_prompt,
-            "frame_images": frame_images
-        })
-
-        print(f"✓ Generated 3 images for Segment {segment_id} ({'img2img' if use_reference else 'txt2img'})")
+    pending_saves = []
+
+    # Prompts are requested concurrently; segment k renders while later prompts are in flight.
+    # Both pools are shut down even if a render fails, cancelling prompts still in flight
+    with PromptPrefetcher(concurrency=PROMPT_CONCURRENCY) as prefetcher, ThreadPoolExecutor(max_workers=1) as saver:
+        prompt_futures = [prefetcher.submit(generate_keyframe_prompt_async(segment, limiter=PROMPT_RATE_LIMITER))
+                          for segment in script_data]
+
+        for segment, prompt_future in zip(script_data, prompt_futures):
+            # Time blocked here is prompt latency the prefetching did not hide
+            with span("keyframe_prompt_wait", segment_id=segment.get("segment_id")):
+                sd_prompts = prompt_future.result()
+            prompt = sd_prompts["prompt"]
+            negative_prompt = sd_prompts["negative_prompt"]
+            segment_id = segment.get("segment_id")
+
+            reference_path = reference_image_path(segment.get("description", ""))
+            use_reference = reference_path is not None
+            seeds = keyframe_variant_seeds(segment_id)
+
+            with span("keyframe_render", segment_id=segment_id, variants=len(seeds),
+                      mode="img2img" if use_reference else "txt2img"):
+                images = render_keyframe_variants(prompt, negative_prompt, seeds, reference_path=reference_path)
+
+            # Save in the background while the next segment denoises
+            frame_images = []
+            for i, image in enumerate(images):
+                image_path = os.path.join(output_dir, f"segment_{segment_id}_v{i+1}.png")
+                pending_saves.append(saver.submit(image.save, image_path))
+                frame_images.append(image_path)
+
+            keyframe_outputs.append({
+                "segment_id": segment_id,
+                "prompt": prompt,
+                "negative_prompt": negative_prompt,
+                "frame_images": frame_images,
+                "seeds": seeds
+            })
+
+            print(f"✓ Generated {len(images)} images for Segment {segment_id} ({'img2img' if use_reference else 'txt2img'})")
+
+        with span("keyframe_save_wait"):
+            for future in pending_saves:
+                future.result()
 
     with open("all_prompts_output.json", "w", encoding="utf-8") as f:
         json.dump(keyframe_outputs, f, ensure_ascii=False, indent=2)
@@ -6,12 +6,24 @@ import math
 from PIL import Image, ImageDraw
 import os
 import shutil
-from utils.keyframe_utils import generate_keyframe_prompt, generate_all_keyframe_images
+import sys
+from pathlib import Path
+
+# utils/ modules import each other flat; one copy of tracing keeps span parents shared
+UTILS_DIR = Path(__file__).resolve().parent / "utils"
+if str(UTILS_DIR) not in sys.path:
+    sys.path.append(str(UTILS_DIR))
+
+from utils.keyframe_utils import generate_keyframe_prompt, generate_all_keyframe_images, compact_prompt_store
+from tracing import configure_tracing, print_trace_summary, span
 
 # Load segments JSON
-def load_segments():
+def load_all_segments():
     with open("museum/segments_full.json", "r", encoding="utf-8") as f:
-        segments = json.load(f)
+        return json.load(f)
+
+def load_segments():
+    segments = load_all_segments()
 
     # Select 5 recommended keyframes for preview
     segment_ids_to_preview = [1, 2, 5, 14, 24]
@@ -19,8 +31,13 @@ def load_segments():
     return preview_segments
 
 # Run the wrapper to generate prompts and images
+configure_tracing("keyframe_trace.jsonl")
 script_json = load_segments()
-generated_sd_prompts = generate_all_keyframe_images(script_json)
+with span("keyframe_run", segments=len(script_json)):
+    generated_sd_prompts = generate_all_keyframe_images(script_json)
+# Keep cached prompts of the whole script (not just the preview), drop edited/removed segments
+compact_prompt_store(load_all_segments())
+print_trace_summary()
 
 # Optionally inspect prompts
 # print(json.dumps(generated_sd_prompts, indent=2, ensure_ascii=False))
@@ -2,10 +2,14 @@ import json
 import os
 import re
 import base64
-import subprocess
-from moviepy.editor import ImageClip, AudioFileClip, concatenate_videoclips
+from xtts_utils import synthesize_lines_batch, release_xtts_model
+from audio_utils import assemble_segment_audio, write_wav
+from build_manifest import BuildManifest
+from render_cache import hash_file
+from ffmpeg_utils import concat_segments, encode_still_segment, SEGMENT_PROFILE
+from segment_pool import render_segments, SegmentRenderError
+from tracing import configure_tracing, print_trace_summary, span
 
-# Assume _generate_voiceover_coqui_xtts is defined as you provided
 # You need `ffmpeg` installed for audio/video processing
 
 # ----------------------------
@@ -14,11 +18,40 @@ from moviepy.editor import ImageClip, AudioFileClip, concatenate_videoclips
 TARGET_LANGUAGE = "zh"  # or "en"
 DESIRED_SPEED = 1.0
 SPEAKER_SAMPLE_B64 = "..."  # Base64 of your reference voice sample
+SPEAKER_WAVS = {}  # Optional per-speaker reference WAVs, e.g. {"太阳人": "voices/sunman.wav"}
+INTER_SPEAKER_SILENCE = 0.4  # seconds of silence when the speaker changes
+SAME_SPEAKER_SILENCE = 0.15  # seconds of silence between lines of one speaker
+NORMALIZE_LOUDNESS = True
+TTS_WORKERS = 0  # >0 synthesizes narration in a process pool
+TTS_TORCH_THREADS = None  # torch threads per TTS worker (default: cores / workers)
+VIDEO_FPS = 24
+KEN_BURNS = False  # slow zoom on each keyframe instead of a static frame
+KEN_BURNS_ZOOM = 1.1  # final zoom factor of the Ken Burns effect
+PARALLEL_RENDER = True  # encode stale segments concurrently in a process pool
+RENDER_CPU_BUDGET = None  # cores shared by all concurrent ffmpeg encodes (default: all)
+FFMPEG_THREADS_PER_JOB = 4  # ffmpeg threads per segment encode within the budget
 OUTPUT_DIR = "museum_v2/output_segments"
 FINAL_VIDEO = "museum_v2/final_video.mp4"
+BUILD_MANIFEST = os.path.join(OUTPUT_DIR, "build_manifest.json")
+TRACE_PATH = os.path.join(OUTPUT_DIR, "trace.jsonl")
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+def get_speaker_sample_path():
+    """
+    Decodes SPEAKER_SAMPLE_B64 to a WAV once, so the XTTS speaker latents
+    (keyed by file content) are computed a single time.
+    """
+    sample_path = os.path.join(OUTPUT_DIR, "speaker_sample.wav")
+    if not os.path.exists(sample_path):
+        with open(sample_path, "wb") as f:
+            f.write(base64.b64decode(SPEAKER_SAMPLE_B64))
+    return sample_path
+
+def speaker_wav_for(speaker):
+    """Reference WAV for a speaker, falling back to the shared speaker sample."""
+    return SPEAKER_WAVS.get(speaker) or get_speaker_sample_path()
+
 def parse_narration(narration_text: str):
     """
     Splits narration into (speaker, text) tuples.
@@ -41,85 +74,189 @@ def parse_narration(narration_text: str):
             parsed.append((None, line.strip()))
     return parsed
 
-def generate_segment_audio(segment_id, narration_text):
+def narration_lines(segment):
+    """Parsed narration lines of a segment as synthesize_lines_batch() inputs."""
+    lines = []
+    for idx, (speaker, text) in enumerate(parse_narration(segment.get("narration", ""))):
+        if not text:
+            continue
+        lines.append({
+            "segment_id": segment["segment_id"],
+            "line_index": idx,
+            "speaker": speaker,
+            "text": text,
+            "speaker_wav": speaker_wav_for(speaker),
+            "language": TARGET_LANGUAGE,
+            "speed": DESIRED_SPEED,
+        })
+    return lines
+
+def synthesize_script_audio(segments):
     """
-    Generate audio file for the segment by concatenating
-    all sub-lines of narration.
+    Synthesizes every narration line of every segment in one batch and
+    returns {segment_id: [line audio, ...]} in narration order.
     """
-    parsed_lines = parse_narration(narration_text)
-    segment_audio_files = []
-
-    for idx, (speaker, text) in enumerate(parsed_lines):
-        audio_path = os.path.join(OUTPUT_DIR, f"segment_{segment_id}_line_{idx}.wav")
-        _generate_voiceover_coqui_xtts(
-            full_text=text,
-            target_language=TARGET_LANGUAGE,
-            desired_speed=DESIRED_SPEED,
-            output_audio_path=audio_path,
-            speaker_sample_b64=SPEAKER_SAMPLE_B64
-        )
-        segment_audio_files.append(audio_path)
+    lines = [line for seg in segments for line in narration_lines(seg)]
+    results = synthesize_lines_batch(lines, num_workers=TTS_WORKERS, torch_threads=TTS_TORCH_THREADS)
+    line_audio = {}
+    for result in results:
+        line_audio.setdefault(result["segment_id"], []).append(result)
+    return line_audio
 
-    if len(segment_audio_files) == 1:
-        return segment_audio_files[0]
-
-    # Concatenate audio files with ffmpeg
-    concat_list_path = os.path.join(OUTPUT_DIR, f"concat_{segment_id}.txt")
-    with open(concat_list_path, "w") as f:
-        for ap in segment_audio_files:
-            f.write(f"file '{os.path.abspath(ap)}'\n")
+def generate_segment_audio(segment_id, narration_text, line_audio=None):
+    """
+    Generate one audio file for the segment by assembling all sub-lines of
+    narration in memory. line_audio is this segment's entry from
+    synthesize_script_audio(); it is synthesized here when not given.
 
-    merged_audio = os.path.join(OUTPUT_DIR, f"segment_{segment_id}_merged.wav")
-    subprocess.run([
-        "ffmpeg", "-y", "-f", "concat", "-safe", "0",
-        "-i", concat_list_path, "-c", "copy", merged_audio
-    ], check=True)
+    Returns (audio_path, line_timestamps), with per-line start/end times
+    within the segment.
+    """
+    if line_audio is None:
+        line_audio = synthesize_lines_batch(narration_lines({"segment_id": segment_id, "narration": narration_text}))
 
-    return merged_audio
+    with span("assemble_audio", segment_id=segment_id, lines=len(line_audio)):
+        samples, sample_rate, line_timestamps = assemble_segment_audio(
+            line_audio,
+            inter_speaker_silence=INTER_SPEAKER_SILENCE,
+            same_speaker_silence=SAME_SPEAKER_SILENCE,
+            normalize=NORMALIZE_LOUDNESS,
+        )
+        audio_path = os.path.join(OUTPUT_DIR, f"segment_{segment_id}.wav")
+        write_wav(samples, sample_rate, audio_path)
+    return audio_path, line_timestamps
 
-def generate_segment_video(segment):
+def generate_segment_video(segment, line_audio=None, audio_path=None):
     """
     Generates a video clip from static image and voiceover audio.
+    An already built audio_path is reused instead of generating the audio.
     """
     segment_id = segment["segment_id"]
-    image_path = f"Final_segment_{segment_id}.png"
     narration = segment.get("narration", "")
-    duration = segment.get("duration", 5)
 
     # Generate audio
-    audio_path = generate_segment_audio(segment_id, narration)
-    audio_clip = AudioFileClip(audio_path)
-    duration = audio_clip.duration  # ensure video matches audio
+    duration = None
+    if audio_path is None:
+        audio_path, line_timestamps = generate_segment_audio(segment_id, narration, line_audio)
+        duration = audio_duration(line_timestamps)
+    # Encode the still image with the audio in one ffmpeg pass
+    fn, args, kwargs = segment_video_job(segment_id, audio_path, duration)
+    return fn(*args, **kwargs)
 
-    # Create static image video with audio
-    img_clip = ImageClip(image_path).set_duration(duration).set_audio(audio_clip)
+def audio_duration(line_timestamps):
+    """Length of an assembled segment track: it ends with its last line."""
+    return line_timestamps[-1]["end"] if line_timestamps else None
+
+def segment_video_job(segment_id, audio_path, duration=None):
+    """The (fn, args, kwargs) encode job of one segment, runnable in a render_segments() worker."""
+    image_path = f"Final_segment_{segment_id}.png"
     out_path = os.path.join(OUTPUT_DIR, f"segment_{segment_id}.mp4")
-    img_clip.write_videofile(out_path, fps=24, codec="libx264", audio_codec="aac")
-    return out_path
+    # ensure video matches audio; encode_still_segment only probes the WAV when duration is unknown
+    return encode_still_segment, (image_path, audio_path, out_path), {
+        "duration": duration, "fps": VIDEO_FPS, "ken_burns": KEN_BURNS, "zoom": KEN_BURNS_ZOOM,
+    }
+
+def segment_audio_inputs(segment):
+    """Everything the segment's narration WAV is built from, for the build manifest."""
+    return {
+        "lines": [(line["speaker"], line["text"], hash_file(line["speaker_wav"])) for line in narration_lines(segment)],
+        "language": TARGET_LANGUAGE,
+        "speed": DESIRED_SPEED,
+        "silence": (INTER_SPEAKER_SILENCE, SAME_SPEAKER_SILENCE),
+        "normalize": NORMALIZE_LOUDNESS,
+    }
 
 def generate_full_video(segments):
+    """
+    Builds the final video, re-rendering only segments whose narration,
+    voice settings or keyframe image changed since the last run.
+    """
+    manifest = BuildManifest(BUILD_MANIFEST)
+    audio_inputs = {}
+    stale_audio = []
+    for seg in segments:
+        audio_inputs[seg["segment_id"]] = segment_audio_inputs(seg)
+        audio_path = os.path.join(OUTPUT_DIR, f"segment_{seg['segment_id']}.wav")
+        if manifest.is_stale(audio_path, audio_inputs[seg["segment_id"]]):
+            stale_audio.append(seg)
+
+    print(f"Synthesizing narration for {len(stale_audio)} of {len(segments)} segments...")
+    with span("tts_batch", segments=len(stale_audio)):
+        script_audio = synthesize_script_audio(stale_audio)
+    # Nothing else needs the TTS model; free it before the encodes
+    release_xtts_model()
+
     segment_videos = []
+    stale_videos = []  # (segment_id, video_inputs, job)
     for seg in segments:
-        print(f"Processing segment {seg['segment_id']}...")
-        seg_video = generate_segment_video(seg)
+        segment_id = seg["segment_id"]
+        audio_path = os.path.join(OUTPUT_DIR, f"segment_{segment_id}.wav")
+        if seg in stale_audio:
+            audio_path, line_timestamps = generate_segment_audio(segment_id, seg.get("narration", ""),
+                                                                 script_audio.get(segment_id, []))
+            manifest.record(audio_path, audio_inputs[segment_id],
+                            metadata={"duration": audio_duration(line_timestamps)})
+        # Recorded when the WAV was built, so unchanged audio is not probed again
+        duration = manifest.metadata(audio_path).get("duration")
+
+        seg_video = os.path.join(OUTPUT_DIR, f"segment_{segment_id}.mp4")
+        video_inputs = {
+            "image": hash_file(f"Final_segment_{segment_id}.png"),
+            "audio": BuildManifest.fingerprint(audio_inputs[segment_id]),
+            "encoding": (SEGMENT_PROFILE, VIDEO_FPS, KEN_BURNS, KEN_BURNS_ZOOM),
+        }
+        if manifest.is_stale(seg_video, video_inputs):
+            stale_videos.append((segment_id, video_inputs, segment_video_job(segment_id, audio_path, duration)))
         segment_videos.append(seg_video)
 
-    # Concatenate segments
-    with open(os.path.join(OUTPUT_DIR, "concat_list.txt"), "w") as f:
-        for vid in segment_videos:
-            f.write(f"file '{os.path.abspath(vid)}'\n")
+    print(f"Rendering {len(stale_videos)} of {len(segments)} segment videos...")
+    if PARALLEL_RENDER:
+        try:
+            with span("render_segments", segments=len(stale_videos)):
+                results = render_segments([job for _, _, job in stale_videos], cpu_budget=RENDER_CPU_BUDGET,
+                                          threads_per_job=FFMPEG_THREADS_PER_JOB)
+            failed = {}
+        except SegmentRenderError as e:
+            results, failed = e.results, e.errors
+    else:
+        results, failed = [], {}
+        for index, (segment_id, _, (fn, args, kwargs)) in enumerate(stale_videos):
+            print(f"Processing segment {segment_id}...")
+            try:
+                with span("segment_encode", segment_id=segment_id):
+                    results.append(fn(*args, **kwargs))
+            except Exception as e:
+                results.append(None)
+                failed[index] = e
+    # Only successful segments are recorded, so a rerun retries just the failed ones
+    for index, ((segment_id, video_inputs, _), seg_video) in enumerate(zip(stale_videos, results)):
+        if index not in failed:
+            manifest.record(seg_video, video_inputs)
+    if failed:
+        manifest.report()
+        raise SegmentRenderError(failed, results)
+
+    final_inputs = {"segments": [(vid, hash_file(vid)) for vid in segment_videos]}
+    if not manifest.is_stale(FINAL_VIDEO, final_inputs):
+        manifest.report()
+        return
 
-    subprocess.run([
-        "ffmpeg", "-y", "-f", "concat", "-safe", "0",
-        "-i", os.path.join(OUTPUT_DIR, "concat_list.txt"),
-        "-c", "copy", FINAL_VIDEO
-    ], check=True)
+    # Concatenate segments (stream copy, conforming any mismatched segment first)
+    with span("concat", segments=len(segment_videos)):
+        concat_segments(segment_videos, FINAL_VIDEO, work_dir=OUTPUT_DIR)
+    manifest.record(FINAL_VIDEO, final_inputs)
+    manifest.report()
     print(f"✅ Final video saved to {FINAL_VIDEO}")
 
 # ----------------------------
 # Usage
 # ----------------------------
 if __name__ == "__main__":
+    configure_tracing(TRACE_PATH)
     with open("segments.json", "r") as f:
         segments = json.load(f)
-    generate_full_video(segments)
+    try:
+        with span("static_video_run", segments=len(segments)):
+            generate_full_video(segments)
+    finally:
+        print_trace_summary()
@@ -1,7 +1,9 @@
 import json
+import os
 
-from subtitle_utils import format_ass_timestamp, format_srt_timestamp, generate_srt_ass_file, burn_in_subtitles
+from subtitle_utils import generate_srt_ass_file, burn_in_subtitles, iter_json_cues
 from video_preprocess_utils import extract_audio_from_video
+from tracing import configure_tracing, print_trace_summary, span
 
 
 # Constants for video processing
@@ -12,6 +14,7 @@ VIDEO_WIDTH = 1280
 VIDEO_HEIGHT = 720
 FONT_PATH = "NotoSansSC-Regular.ttf"
 OUTPUT_AUDIO = "extracted_audio.wav" # New constant for extracted audio file
+TRACE_PATH = "subtitle_trace.jsonl"
 
 def main():
     """Main function to load video, generate subtitles, and burn them in."""
@@ -19,45 +22,53 @@ def main():
     # Define subtitle file paths
     srt_output_file = "output.srt"
     ass_output_file = "output.ass"
+    vtt_output_file = "output.vtt"
 
     # 0. Extract audio from the video
     print(f"Extracting audio from {CURRENT_VIDEO}...")
-    if not extract_audio_from_video(CURRENT_VIDEO, OUTPUT_AUDIO):
+    with span("extract_audio"):
+        extracted = extract_audio_from_video(CURRENT_VIDEO, OUTPUT_AUDIO)
+    if not extracted:
         print("Audio extraction failed. Exiting.")
         return
     print("Audio extraction complete.")
 
-    # a. Load the INPUT_JSON
-    try:
-        with open(INPUT_JSON, 'r', encoding='utf-8') as f:
-            segments = json.load(f)
-    except FileNotFoundError:
+    # a. Check the INPUT_JSON; cues are streamed from it while writing the subtitles
+    if not os.path.exists(INPUT_JSON):
         print(f"Error: {INPUT_JSON} not found.")
         return
+
+    # b. Generate ASS, SRT and WebVTT files in one pass
+    print("Generating SRT, ASS and WebVTT subtitle files...")
+    try:
+        with span("generate_subtitles"):
+            generate_srt_ass_file(
+                segments=iter_json_cues(INPUT_JSON),
+                srt_output_path=srt_output_file,
+                ass_output_path=ass_output_file,
+                vtt_output_path=vtt_output_file,
+                video_width=VIDEO_WIDTH,
+                video_height=VIDEO_HEIGHT,
+                font_path=FONT_PATH,
+                font_color="#FFFF00", # Yellow font
+                outline_color="#000000", # Black outline
+                opacity=0.9,
+                margin_bottom_percent=0.05
+            )
     except json.JSONDecodeError:
         print(f"Error: Could not decode JSON from {INPUT_JSON}.")
         return
-
-    # b. Generate ASS and SRT files
-    print("Generating SRT and ASS subtitle files...")
-    generate_srt_ass_file(
-        segments=segments,
-        srt_output_path=srt_output_file,
-        ass_output_path=ass_output_file,
-        video_width=VIDEO_WIDTH,
-        video_height=VIDEO_HEIGHT,
-        font_path=FONT_PATH,
-        font_color="#FFFF00", # Yellow font
-        outline_color="#000000", # Black outline
-        opacity=0.9,
-        margin_bottom_percent=0.05
-    )
     print("Subtitle files generated.")
 
     # c. Burn in subtitle into FINAL_VIDEO
     print(f"Burning subtitles into {CURRENT_VIDEO} to create {FINAL_VIDEO}...")
-    burn_in_subtitles(CURRENT_VIDEO, ass_output_file, FINAL_VIDEO, FONT_PATH)
+    with span("burn_in_subtitles"):
+        # Only GOPs that carry a cue are re-encoded; falls back to a full encode if the video cannot be spliced
+        burn_in_subtitles(CURRENT_VIDEO, ass_output_file, FINAL_VIDEO, FONT_PATH, smart_render=True)
     print("Video processing complete.")
 
 if __name__ == "__main__":
-    main()
+    configure_tracing(TRACE_PATH)
+    with span("subtitle_run"):
+        main()
+    print_trace_summary()
@@ -0,0 +1,8 @@
+import sys
+from pathlib import Path
+
+# The pipeline modules import each other flat from utils/ (see benchmark.py)
+MUSEUM_DIR = Path(__file__).resolve().parent.parent
+for path in (MUSEUM_DIR, MUSEUM_DIR / "utils"):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
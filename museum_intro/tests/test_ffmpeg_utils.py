@@ -0,0 +1,53 @@
+import json
+import shutil
+import subprocess
+
+import pytest
+
+pytest.importorskip("numpy")
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None,
+                                reason="ffmpeg is not installed")
+
+from ffmpeg_utils import LOSSLESS_CLIP_PROFILE, encode_segment, stream_frames_to_video  # noqa: E402
+
+FPS = 16
+
+
+def lavfi(source: str, output_path, seconds: float):
+    subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi", "-i", source, "-t", str(seconds),
+                    str(output_path)], check=True)
+    return str(output_path)
+
+
+def stream_durations(path) -> dict:
+    result = subprocess.run(["ffprobe", "-v", "error", "-show_entries", "stream=codec_type,duration",
+                             "-of", "json", str(path)], check=True, capture_output=True, text=True)
+    return {s["codec_type"]: float(s["duration"]) for s in json.loads(result.stdout)["streams"]}
+
+
+@pytest.mark.parametrize("audio_seconds", [7.0, 1.0])
+def test_encode_segment_fits_audio_to_video(tmp_path, audio_seconds):
+    import numpy as np
+
+    frames = [np.full((64, 96, 3), i * 8, dtype=np.uint8) for i in range(2 * FPS)]
+    clip = stream_frames_to_video(frames, str(tmp_path / "clip.mp4"), FPS, **LOSSLESS_CLIP_PROFILE)
+    audio = lavfi("sine=frequency=440:sample_rate=24000", tmp_path / "narration.wav", audio_seconds)
+
+    segment = encode_segment(clip, str(tmp_path / "segment.mp4"), audio_path=audio, fps=FPS)
+
+    durations = stream_durations(segment)
+    assert durations["video"] == pytest.approx(2.0, abs=1 / FPS)
+    assert durations["audio"] == pytest.approx(durations["video"], abs=1 / FPS)
+
+
+def test_frame_writer_fits_audio_to_streamed_frames(tmp_path):
+    import numpy as np
+
+    audio = lavfi("sine=frequency=440:sample_rate=24000", tmp_path / "narration.wav", 7.0)
+    frames = [np.zeros((64, 96, 3), dtype=np.uint8)] * (2 * FPS)
+
+    segment = stream_frames_to_video(frames, str(tmp_path / "segment.mp4"), FPS, audio_path=audio,
+                                     duration=len(frames) / FPS)
+
+    durations = stream_durations(segment)
+    assert durations["audio"] == pytest.approx(durations["video"], abs=1 / FPS)
@@ -0,0 +1,33 @@
+from prompt_store import PromptStore
+
+
+def test_compact_keep_drops_stale_keys_and_shrinks_log(tmp_path):
+    log_path = tmp_path / "prompt_log.jsonl"
+    store = PromptStore(log_path)
+    keys = [PromptStore.key_for(description=f"segment {i}") for i in range(10)]
+    for i, key in enumerate(keys):
+        store.put(key, {"segment_id": i, "prompt": f"prompt {i}", "negative_prompt": ""})
+    size_before = log_path.stat().st_size
+
+    # Segments 3..9 were edited or deleted; only 0..2 are still in the script
+    store.compact(keep=keys[:3])
+
+    assert log_path.stat().st_size < size_before
+    assert len(log_path.read_text(encoding="utf-8").splitlines()) == 3
+    assert len(store) == 3
+    reopened = PromptStore(log_path)
+    assert reopened.get(keys[0])["prompt"] == "prompt 0"
+    assert reopened.get(keys[5]) is None
+
+
+def test_compact_without_keep_keeps_latest_record_per_key(tmp_path):
+    log_path = tmp_path / "prompt_log.jsonl"
+    store = PromptStore(log_path)
+    key = PromptStore.key_for(description="segment")
+    store.put(key, {"prompt": "old"})
+    store.put(key, {"prompt": "new"})
+
+    store.compact()
+
+    assert len(log_path.read_text(encoding="utf-8").splitlines()) == 1
+    assert PromptStore(log_path).get(key)["prompt"] == "new"
@@ -0,0 +1,33 @@
+import json
+
+import pytest
+
+pytest.importorskip("numpy")  # via ffmpeg_utils
+pytest.importorskip("PIL")
+
+from subtitle_utils import iter_json_cues, timed_narration_cues  # noqa: E402
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7])
+def test_iter_json_cues_keeps_values_split_across_chunks(tmp_path, chunk_size):
+    cues = [12, 345, -6.5e3, True, None, "a,b]", {"start": 1.25, "end": 2.5, "text": "你好"}, [1, 2]]
+    path = tmp_path / "cues.json"
+    path.write_text(json.dumps(cues, ensure_ascii=False), encoding="utf-8")
+
+    assert list(iter_json_cues(str(path), chunk_size=chunk_size)) == cues
+
+
+def test_iter_json_cues_rejects_unterminated_array(tmp_path):
+    path = tmp_path / "cues.json"
+    path.write_text("[1, 2", encoding="utf-8")
+
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_json_cues(str(path), chunk_size=2))
+
+
+def test_timed_narration_cues_drop_speaker_labels():
+    cues = list(timed_narration_cues("太阳人: 欢迎来到博物馆\n博小翼：你好\n\nno label here", 6.0))
+
+    assert [text for _, _, text in cues] == ["欢迎来到博物馆", "你好", "no label here"]
+    assert cues[0][0] == 0.0
+    assert cues[-1][1] == pytest.approx(6.0)
@@ -0,0 +1,88 @@
+import types
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import t2v_utils  # noqa: E402
+from ffmpeg_utils import segment_writer_kwargs  # noqa: E402
+from t2v_utils import WAN_TEMPORAL_SCALE, plan_long_clip_windows  # noqa: E402
+
+WINDOW_OVERLAPS = [(window, overlap) for window in (5, 17, 21, 33, 49, 81) for overlap in (0, 1, 8, 12, 16, 24, 40)]
+
+
+class StubWanPipeline:
+    """Returns one black video of num_frames frames per call, checking the latent slice matches."""
+
+    device = "cpu"
+
+    def __call__(self, num_frames, height, width, latents, **_):
+        assert latents.shape[2] == (num_frames - 1) // WAN_TEMPORAL_SCALE + 1
+        return types.SimpleNamespace(frames=np.zeros((1, num_frames, height, width, 3), dtype=np.float32))
+
+
+class RecordingWriter:
+    def __init__(self, output_path, fps, width=None, height=None, **kwargs):
+        self.kwargs = kwargs
+        self.frames_written = 0
+
+    def write(self, frame):
+        self.frames_written += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        RecordingWriter.last = self
+        return False
+
+
+@pytest.mark.parametrize("window_frames, overlap_frames", WINDOW_OVERLAPS)
+def test_plan_long_clip_windows_keeps_overlap_under_half_a_window(window_frames, overlap_frames):
+    window, stride, overlap, num_windows = plan_long_clip_windows(200, window_frames, overlap_frames)
+
+    assert stride % WAN_TEMPORAL_SCALE == 0
+    assert overlap == window - stride
+    assert 0 < overlap <= (window - 1) // 2
+    assert window + (num_windows - 1) * stride >= 200
+
+
+@pytest.mark.parametrize("window_frames, overlap_frames", WINDOW_OVERLAPS)
+@pytest.mark.parametrize("num_frames", [3, 33, 100, 161])
+def test_long_clip_writes_every_frame_once(monkeypatch, num_frames, window_frames, overlap_frames):
+    monkeypatch.setattr(t2v_utils, "get_wan_pipeline", lambda *args, **kwargs: StubWanPipeline())
+    monkeypatch.setattr(t2v_utils, "_long_clip_noise",
+                        lambda pipe, num_latent_frames, height, width, seed=None: np.zeros((1, 1, num_latent_frames, 1, 1)))
+    monkeypatch.setattr(t2v_utils, "FFmpegFrameWriter", RecordingWriter)
+
+    t2v_utils.generate_long_video_clip("prompt", num_frames / 16, "clip.mp4", height=2, width=2, fps=16,
+                                       window_frames=window_frames, overlap_frames=overlap_frames)
+
+    assert RecordingWriter.last.frames_written == num_frames
+
+
+def test_long_clip_with_audio_writes_a_final_segment(monkeypatch):
+    monkeypatch.setattr(t2v_utils, "get_wan_pipeline", lambda *args, **kwargs: StubWanPipeline())
+    monkeypatch.setattr(t2v_utils, "_long_clip_noise",
+                        lambda pipe, num_latent_frames, height, width, seed=None: np.zeros((1, 1, num_latent_frames, 1, 1)))
+    monkeypatch.setattr(t2v_utils, "FFmpegFrameWriter", RecordingWriter)
+
+    t2v_utils.generate_long_video_clip("prompt", 100 / 16, "segment.mp4", height=2, width=2, fps=16,
+                                       audio_path="narration.wav", window_frames=33)
+
+    assert RecordingWriter.last.kwargs == segment_writer_kwargs("narration.wav", None, 100 / 16)
+
+
+def test_batch_sends_clips_longer_than_a_window_to_long_clip_generation(monkeypatch):
+    long_calls = []
+    monkeypatch.setattr(t2v_utils, "generate_long_video_clip",
+                        lambda prompt, duration, video_path, **kwargs: long_calls.append((video_path, kwargs)))
+    clips = [{"prompt": "a", "duration": 30.0, "video_path": "a.mp4", "seed": 1},
+             {"prompt": "b", "duration": 45.0, "video_path": "b.mp4", "seed": 2}]
+
+    paths = t2v_utils.generate_video_clips_batch(clips, fps=16, writer_kwargs={"crf": 0},
+                                                 window_frames=81, overlap_frames=16)
+
+    assert paths == ["a.mp4", "b.mp4"]
+    assert [(path, kwargs["seed"], kwargs["window_frames"], kwargs["writer_kwargs"]["crf"])
+            for path, kwargs in long_calls] == [("a.mp4", 1, 81, 0), ("b.mp4", 2, 81, 0)]
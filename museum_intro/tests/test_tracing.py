@@ -0,0 +1,30 @@
+import json
+import os
+import time
+
+import pytest
+
+import tracing
+
+pytestmark = pytest.mark.skipif(not os.path.exists("/proc/self/statm"), reason="needs /proc for current RSS")
+
+ALLOCATION_MB = 200
+
+
+def test_span_peak_rss_is_per_span(tmp_path, monkeypatch):
+    trace_path = tmp_path / "trace.jsonl"
+    monkeypatch.setenv(tracing.TRACE_PATH_ENV, str(trace_path))
+    monkeypatch.setenv(tracing.TRACE_RUN_ENV, "test")
+
+    with tracing.span("allocate"):
+        block = b"x" * (ALLOCATION_MB * 1024 ** 2)
+        time.sleep(0.3)
+        del block
+    with tracing.span("after"):
+        time.sleep(0.3)
+
+    records = {r["name"]: r for r in map(json.loads, trace_path.read_text().splitlines())}
+    allocate, after = records["allocate"], records["after"]
+    assert allocate["peak_rss_mb"] - allocate["start_rss_mb"] > ALLOCATION_MB * 0.75
+    assert allocate["end_rss_mb"] < allocate["peak_rss_mb"] - ALLOCATION_MB * 0.75
+    assert after["peak_rss_mb"] < allocate["peak_rss_mb"] - ALLOCATION_MB * 0.75
@@ -0,0 +1,81 @@
+import logging
+
+import numpy as np
+import soundfile as sf
+
+logger = logging.getLogger(__name__)
+
+
+def db_to_gain(db: float) -> float:
+    return 10 ** (db / 20)
+
+
+def normalize_loudness(samples: np.ndarray, target_rms_db: float = -20.0, peak_db: float = -1.0) -> np.ndarray:
+    """
+    Scales samples to a target RMS level (dBFS), limited so the peak
+    stays below peak_db. Silent input is returned unchanged.
+    """
+    samples = np.asarray(samples, dtype=np.float32)
+    rms = float(np.sqrt(np.mean(np.square(samples)))) if samples.size else 0.0
+    if rms == 0.0:
+        return samples
+    gain = db_to_gain(target_rms_db) / rms
+    peak = float(np.max(np.abs(samples)))
+    gain = min(gain, db_to_gain(peak_db) / peak)
+    return samples * gain
+
+
+def assemble_segment_audio(line_audio: list,
+                           inter_speaker_silence: float = 0.4,
+                           same_speaker_silence: float = 0.15,
+                           normalize: bool = True,
+                           target_rms_db: float = -20.0):
+    """
+    Joins per-line audio buffers into one segment track in memory.
+
+    line_audio items carry "samples" and "sample_rate" (as returned by
+    xtts_utils.synthesize_lines_batch) and optionally "speaker". Silence is
+    inserted between lines, longer when the speaker changes, and each line is
+    loudness-normalized so voices sit at the same level.
+
+    Returns (samples, sample_rate, timestamps) where timestamps holds the
+    start/end time in seconds of every line within the segment.
+    """
+    if not line_audio:
+        return np.zeros(0, dtype=np.float32), 24000, []
+
+    sample_rate = line_audio[0]["sample_rate"]
+    pieces = []
+    timestamps = []
+    cursor = 0
+    previous_speaker = None
+    for index, line in enumerate(line_audio):
+        if line["sample_rate"] != sample_rate:
+            raise ValueError(f"Line {index} has sample rate {line['sample_rate']}, expected {sample_rate}")
+        if index > 0:
+            gap = inter_speaker_silence if line.get("speaker") != previous_speaker else same_speaker_silence
+            gap_samples = int(round(gap * sample_rate))
+            pieces.append(np.zeros(gap_samples, dtype=np.float32))
+            cursor += gap_samples
+
+        samples = np.asarray(line["samples"], dtype=np.float32)
+        if normalize:
+            samples = normalize_loudness(samples, target_rms_db)
+        pieces.append(samples)
+        timestamps.append({
+            "line_index": line.get("line_index", index),
+            "speaker": line.get("speaker"),
+            "text": line.get("text", ""),
+            "start": cursor / sample_rate,
+            "end": (cursor + len(samples)) / sample_rate,
+        })
+        cursor += len(samples)
+        previous_speaker = line.get("speaker")
+
+    return np.concatenate(pieces), sample_rate, timestamps
+
+
+def write_wav(samples: np.ndarray, sample_rate: int, output_path: str) -> str:
+    sf.write(output_path, samples, sample_rate, subtype="PCM_16")
+    logger.info(f"Wrote {len(samples) / sample_rate:.2f}s of audio to {output_path}")
+    return output_path
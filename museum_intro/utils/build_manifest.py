@@ -0,0 +1,105 @@
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+# One cache key implementation keeps manifest fingerprints and render/TTS
+# cache keys from drifting apart
+from render_cache import make_cache_key
+
+logger = logging.getLogger(__name__)
+
+
+class BuildManifest:
+    """
+    Make-style record of how each artifact was built.
+
+    For every artifact path the manifest stores a fingerprint of its inputs
+    (parameters, input file hashes and the fingerprints of upstream
+    artifacts). An artifact is stale when its file is missing or the
+    fingerprint of its current inputs differs; everything else is skipped.
+    Because downstream inputs include upstream fingerprints, a changed input
+    invalidates exactly the artifacts that depend on it.
+
+        manifest = BuildManifest("build_manifest.json")
+        inputs = {"narration": text, "speaker_wav": hash_file(wav)}
+        if manifest.is_stale(audio_path, inputs):
+            synthesize(...)
+            manifest.record(audio_path, inputs)
+        manifest.report()
+    """
+
+    def __init__(self, path="build_manifest.json"):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.decisions = {}
+        if self.path.exists():
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._entries = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                logger.warning(f"Build manifest at {self.path} is unreadable, rebuilding everything.")
+
+    @staticmethod
+    def fingerprint(inputs: dict) -> str:
+        return make_cache_key(**inputs)
+
+    def is_stale(self, artifact, inputs: dict) -> bool:
+        """Returns True if artifact must be rebuilt, recording the reason for report()."""
+        artifact = str(artifact)
+        entry = self._entries.get(artifact)
+        if not os.path.exists(artifact):
+            reason = "output missing"
+        elif entry is None:
+            reason = "not in manifest"
+        elif entry["fingerprint"] != self.fingerprint(inputs):
+            changed = sorted(
+                name for name in set(inputs) | set(entry.get("inputs", {}))
+                if json.dumps(inputs.get(name), sort_keys=True, default=str)
+                != json.dumps(entry.get("inputs", {}).get(name), sort_keys=True, default=str)
+            )
+            reason = f"inputs changed: {', '.join(changed)}"
+        else:
+            with self._lock:
+                self.decisions[artifact] = ("skipped", "up to date")
+            return False
+        with self._lock:
+            self.decisions[artifact] = ("rebuilt", reason)
+        return True
+
+    def record(self, artifact, inputs: dict, metadata: dict = None):
+        """
+        Marks artifact as built from inputs and saves the manifest. metadata
+        (e.g. a duration) is kept with the entry for later runs to read.
+        """
+        with self._lock:
+            self._entries[str(artifact)] = {
+                "fingerprint": self.fingerprint(inputs),
+                "inputs": json.loads(json.dumps(inputs, default=str)),
+                **({"metadata": json.loads(json.dumps(metadata, default=str))} if metadata else {}),
+            }
+            self._save_locked()
+
+    def metadata(self, artifact) -> dict:
+        """Metadata recorded with artifact, or an empty dict."""
+        with self._lock:
+            return dict(self._entries.get(str(artifact), {}).get("metadata", {}))
+
+    def _save_locked(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._entries, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def report(self):
+        """Prints what was rebuilt or skipped in this run, and why."""
+        rebuilt = {a: r for a, (d, r) in self.decisions.items() if d == "rebuilt"}
+        skipped = [a for a, (d, _) in self.decisions.items() if d == "skipped"]
+        print(f"🧱 Build: {len(rebuilt)} rebuilt, {len(skipped)} up to date")
+        for artifact, reason in rebuilt.items():
+            print(f"  rebuilt {artifact}: {reason}")
+        for artifact in skipped:
+            print(f"  skipped {artifact}: up to date")
@@ -0,0 +1,436 @@
+import json
+import logging
+import math
+import os
+import subprocess
+import time
+from collections import Counter
+
+import numpy as np
+
+from tracing import record_ffmpeg_time, run_ffmpeg
+
+logger = logging.getLogger(__name__)
+
+
+def frame_to_uint8(frame) -> np.ndarray:
+    """Converts one HxWx3 frame (float in [0, 1], uint8 or PIL image) to contiguous uint8 RGB."""
+    frame = np.asarray(frame)
+    if frame.dtype != np.uint8:
+        frame = (np.clip(frame, 0.0, 1.0) * 255).round().astype(np.uint8)
+    if frame.ndim == 2:
+        frame = np.stack([frame] * 3, axis=-1)
+    return np.ascontiguousarray(frame[..., :3])
+
+
+class FFmpegFrameWriter:
+    """
+    Streams RGB frames into an ffmpeg encoder subprocess one at a time, so only
+    the frame being written is held in memory.
+
+    When audio_path and/or subtitle_path are given the output is the final
+    muxed segment: subtitles are burned in and the audio resampled through
+    one filter graph (see segment_filter_graph), so no intermediate clip has
+    to be written and re-encoded. Pass duration (frames / fps) with audio so
+    the track is padded or trimmed to the video inside the graph.
+
+        with FFmpegFrameWriter("out.mp4", fps=16) as writer:
+            for frame in frames:
+                writer.write(frame)
+    """
+
+    def __init__(self, output_path: str, fps: float,
+                 width: int = None, height: int = None,
+                 codec: str = "libx264",
+                 crf: int = 18,
+                 preset: str = "medium",
+                 pix_fmt: str = "yuv420p",
+                 audio_path: str = None,
+                 audio_codec: str = "aac",
+                 subtitle_path: str = None,
+                 sample_rate: int = None,
+                 channels: int = None,
+                 duration: float = None,
+                 extra_output_args: list = None):
+        self.output_path = output_path
+        self.fps = fps
+        self.width = width
+        self.height = height
+        self.codec = codec
+        self.crf = crf
+        self.preset = preset
+        self.pix_fmt = pix_fmt
+        self.audio_path = audio_path
+        self.audio_codec = audio_codec
+        self.subtitle_path = subtitle_path
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.duration = duration
+        self.extra_output_args = extra_output_args or []
+        self.frames_written = 0
+        self._proc = None
+
+    def _build_command(self) -> list:
+        command = [
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "rgb24",
+            "-s", f"{self.width}x{self.height}",
+            "-r", str(self.fps),
+            "-i", "pipe:0",
+        ]
+        if self.audio_path:
+            command += ["-i", self.audio_path]
+        if self.audio_path or self.subtitle_path:
+            command += segment_filter_graph(self.subtitle_path, self.pix_fmt,
+                                            has_audio=bool(self.audio_path),
+                                            sample_rate=self.sample_rate, channels=self.channels,
+                                            duration=self.duration)
+        command += ["-c:v", self.codec, "-pix_fmt", self.pix_fmt]
+        if self.crf is not None:
+            command += ["-crf", str(self.crf)]
+        if self.preset:
+            command += ["-preset", self.preset]
+        if self.audio_path:
+            command += ["-c:a", self.audio_codec]
+            if not self.duration:
+                # -shortest alone does not cut filtered audio; end at the shorter stream without buffering ahead
+                command += ["-shortest", "-fflags", "+shortest", "-max_interleave_delta", "0"]
+        command += self.extra_output_args
+        command.append(self.output_path)
+        return command
+
+    def _start(self):
+        command = self._build_command()
+        logger.info("Starting ffmpeg encoder: %s", " ".join(command))
+        self._proc = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def write(self, frame):
+        frame = frame_to_uint8(frame)
+        if self._proc is None:
+            if self.width is None or self.height is None:
+                self.height, self.width = frame.shape[:2]
+            self._start()
+        if frame.shape[:2] != (self.height, self.width):
+            raise ValueError(f"Frame size {frame.shape[1]}x{frame.shape[0]} does not match {self.width}x{self.height}")
+        # Time blocked on the pipe is time spent waiting for the encoder
+        start = time.perf_counter()
+        self._proc.stdin.write(frame.tobytes())
+        record_ffmpeg_time(time.perf_counter() - start)
+        self.frames_written += 1
+
+    def write_frames(self, frames):
+        for frame in frames:
+            self.write(frame)
+
+    def close(self):
+        if self._proc is None:
+            return
+        start = time.perf_counter()
+        self._proc.stdin.close()
+        stderr = self._proc.stderr.read()
+        returncode = self._proc.wait()
+        record_ffmpeg_time(time.perf_counter() - start)
+        self._proc = None
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, "ffmpeg", stderr=stderr)
+        logger.info(f"Wrote {self.frames_written} frames to {self.output_path}")
+
+    def abort(self):
+        if self._proc is not None:
+            self._proc.kill()
+            self._proc.wait()
+            self._proc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def _filter_path(path: str) -> str:
+    """Escapes a file path for use inside a single-quoted filter option value."""
+    return str(path).replace("\\", "/").replace("'", "'\\''")
+
+
+def segment_filter_graph(subtitle_path: str = None, pix_fmt: str = "yuv420p", has_audio: bool = True,
+                         sample_rate: int = None, channels: int = None, video_filters: list = None,
+                         duration: float = None) -> list:
+    """
+    -filter_complex and -map arguments for a final segment, with video from
+    input 0 and audio from input 1: video_filters run first, then subtitles
+    are burned in and the pixel format set on the video chain, and the audio
+    is resampled to the segment profile, so a single encode produces the
+    finished segment.
+
+    With duration (the video length in seconds) the audio is padded with
+    silence and trimmed to exactly that length; -shortest does not cut
+    streams that come out of a filter graph.
+    """
+    video_chain = list(video_filters or [])
+    if subtitle_path:
+        video_chain.append(f"subtitles=filename='{_filter_path(subtitle_path)}'")
+    video_chain.append(f"format={pix_fmt}")
+    graph = [f"[0:v]{','.join(video_chain)}[v]"]
+    maps = ["-map", "[v]"]
+    if has_audio:
+        audio_chain = []
+        if sample_rate:
+            audio_chain.append(f"aresample={sample_rate}")
+        if channels:
+            audio_chain.append(f"aformat=channel_layouts={'stereo' if channels == 2 else 'mono'}")
+        if duration:
+            audio_chain += ["apad", f"atrim=end={duration:.6f}"]
+        graph.append(f"[1:a]{','.join(audio_chain) or 'anull'}[a]")
+        maps += ["-map", "[a]"]
+    return ["-filter_complex", ";".join(graph)] + maps
+
+
+# Encoding profile shared by every final segment, so concat_segments can join them with -c copy
+SEGMENT_PROFILE = {
+    "codec": "libx264",
+    "crf": 18,
+    "preset": "medium",
+    "pix_fmt": "yuv420p",
+    "audio_codec": "aac",
+    "sample_rate": 48000,
+    "channels": 2,
+}
+SEGMENT_TIMESCALE = 90000
+
+# Visually lossless intermediate for clips that are encoded once more into a final segment
+LOSSLESS_CLIP_PROFILE = {"codec": "libx264rgb", "crf": 0, "preset": "ultrafast", "pix_fmt": "rgb24"}
+
+
+def segment_output_args() -> list:
+    return ["-video_track_timescale", str(SEGMENT_TIMESCALE), "-movflags", "+faststart"]
+
+
+def segment_writer_kwargs(audio_path: str = None, subtitle_path: str = None, duration: float = None) -> dict:
+    """FFmpegFrameWriter kwargs that write a finished segment in the shared SEGMENT_PROFILE."""
+    return dict(SEGMENT_PROFILE, audio_path=audio_path, subtitle_path=subtitle_path, duration=duration,
+                extra_output_args=segment_output_args())
+
+
+def encode_segment(video_path: str, output_path: str, audio_path: str = None, subtitle_path: str = None,
+                   fps: float = None, threads: int = None, duration: float = None) -> str:
+    """
+    Encodes an existing clip plus its audio and subtitles into a finished
+    segment with one decode, one filter graph and one encode in the shared
+    SEGMENT_PROFILE. The audio is padded or trimmed to duration, which
+    defaults to the length of the clip.
+    """
+    if audio_path and duration is None:
+        duration = probe_media(video_path)["duration"]
+    command = ["ffmpeg", "-y", "-loglevel", "error", "-i", video_path]
+    if audio_path:
+        command += ["-i", audio_path]
+    command += segment_filter_graph(subtitle_path, SEGMENT_PROFILE["pix_fmt"], has_audio=bool(audio_path),
+                                    sample_rate=SEGMENT_PROFILE["sample_rate"], channels=SEGMENT_PROFILE["channels"],
+                                    duration=duration)
+    command += ["-c:v", SEGMENT_PROFILE["codec"], "-crf", str(SEGMENT_PROFILE["crf"]),
+                "-preset", SEGMENT_PROFILE["preset"], "-pix_fmt", SEGMENT_PROFILE["pix_fmt"]]
+    if fps:
+        command += ["-r", str(fps)]
+    if audio_path:
+        command += ["-c:a", SEGMENT_PROFILE["audio_codec"]]
+    if duration:
+        command += ["-t", f"{duration:.6f}"]
+    if threads:
+        command += ["-threads", str(threads)]
+    command += segment_output_args()
+    command.append(output_path)
+    run_ffmpeg(command, check=True)
+    return output_path
+
+
+def still_image_filters(frames: int, fps: float, width: int = None, height: int = None,
+                        ken_burns: bool = False, zoom: float = 1.1) -> list:
+    """
+    Video filters that turn one decoded image into frames output frames.
+
+    Without ken_burns the single frame is repeated by the loop filter; with
+    it, zoompan emits every frame from the one input image, zooming towards
+    zoom around the centre over the whole segment.
+    """
+    if ken_burns:
+        size = f"{width}x{height}" if width and height else "hd720"
+        return [
+            # Upscale first so the sub-pixel crop steps of zoompan do not jitter
+            "scale=iw*4:ih*4:flags=lanczos",
+            f"zoompan=z='1+{zoom - 1:.4f}*on/{max(1, frames - 1)}'"
+            f":x='iw/2-(iw/zoom/2)':y='ih/2-(ih/zoom/2)':d={frames}:s={size}:fps={fps}",
+        ]
+    scale = f"scale={width}:{height}" if width and height else "scale=trunc(iw/2)*2:trunc(ih/2)*2"
+    return [scale, f"loop=loop={frames - 1}:size=1:start=0", f"setpts=N/({fps}*TB)"]
+
+
+def encode_still_segment(image_path: str, audio_path: str, output_path: str, duration: float = None,
+                         fps: float = 24, width: int = None, height: int = None,
+                         ken_burns: bool = False, zoom: float = 1.1, threads: int = None) -> str:
+    """
+    Encodes a still image plus narration into a finished segment in one pass.
+
+    The image is decoded once and repeated inside the filter graph, and the
+    encoder is tuned for static content (-tune stillimage, one keyframe for
+    the whole segment), so almost every frame is an empty P-frame. The output
+    uses SEGMENT_PROFILE, so segments can be stream-copied by concat_segments.
+    duration defaults to the length of the audio.
+    """
+    if duration is None:
+        duration = probe_media(audio_path)["duration"]
+    frames = max(1, math.ceil(duration * fps))
+    command = ["ffmpeg", "-y", "-loglevel", "error", "-i", image_path, "-i", audio_path]
+    command += segment_filter_graph(
+        pix_fmt=SEGMENT_PROFILE["pix_fmt"], sample_rate=SEGMENT_PROFILE["sample_rate"],
+        channels=SEGMENT_PROFILE["channels"],
+        video_filters=still_image_filters(frames, fps, width, height, ken_burns, zoom),
+        duration=duration,
+    )
+    command += ["-c:v", SEGMENT_PROFILE["codec"], "-crf", str(SEGMENT_PROFILE["crf"]),
+                "-preset", SEGMENT_PROFILE["preset"], "-pix_fmt", SEGMENT_PROFILE["pix_fmt"],
+                "-g", str(frames), "-r", str(fps)]
+    if not ken_burns:
+        command += ["-tune", "stillimage"]
+    command += ["-c:a", SEGMENT_PROFILE["audio_codec"], "-t", f"{duration:.3f}"]
+    if threads:
+        command += ["-threads", str(threads)]
+    command += segment_output_args()
+    command.append(output_path)
+    run_ffmpeg(command, check=True)
+    return output_path
+
+
+def stream_frames_to_video(frames, output_path: str, fps: float, **writer_kwargs) -> str:
+    """Encodes an iterable of frames with FFmpegFrameWriter and returns output_path."""
+    with FFmpegFrameWriter(output_path, fps, **writer_kwargs) as writer:
+        writer.write_frames(frames)
+    return output_path
+
+
+# Stream properties that must match for the concat demuxer to join files with -c copy
+CONCAT_PROFILE_KEYS = ("video_codec", "width", "height", "pix_fmt", "time_base", "frame_rate",
+                       "audio_codec", "sample_rate", "channels")
+
+# ffmpeg encoders for the codec names ffprobe reports
+ENCODERS = {"h264": "libx264", "hevc": "libx265", "aac": "aac", "mp3": "libmp3lame", "opus": "libopus"}
+
+
+def probe_media(path: str, keyframes: bool = False) -> dict:
+    """
+    Returns the stream profile of a media file using ffprobe: the fields
+    concat needs, the H.264 parameters that must match to splice streams
+    (video_profile, level, refs, has_b_frames) and, with keyframes=True,
+    the sorted keyframe times of the video stream.
+    """
+    command = [
+        "ffprobe", "-v", "error",
+        "-show_entries", "stream=index,codec_type,codec_name,profile,level,refs,has_b_frames,"
+                         "width,height,pix_fmt,time_base,r_frame_rate,sample_rate,channels",
+        "-show_entries", "format=duration",
+    ]
+    if keyframes:
+        command += ["-show_entries", "packet=stream_index,pts_time,flags"]
+    result = run_ffmpeg(command + ["-of", "json", path], check=True, capture_output=True, text=True)
+    info = json.loads(result.stdout)
+    video = next((s for s in info.get("streams", []) if s.get("codec_type") == "video"), {})
+    audio = next((s for s in info.get("streams", []) if s.get("codec_type") == "audio"), {})
+    profile = {
+        "video_codec": video.get("codec_name"),
+        "width": video.get("width"),
+        "height": video.get("height"),
+        "pix_fmt": video.get("pix_fmt"),
+        "time_base": video.get("time_base"),
+        "frame_rate": video.get("r_frame_rate"),
+        "video_profile": video.get("profile"),
+        "level": video.get("level"),
+        "refs": video.get("refs"),
+        "has_b_frames": video.get("has_b_frames"),
+        "audio_codec": audio.get("codec_name"),
+        "sample_rate": int(audio["sample_rate"]) if audio.get("sample_rate") else None,
+        "channels": audio.get("channels"),
+        "duration": float(info.get("format", {}).get("duration", 0) or 0),
+    }
+    if keyframes:
+        profile["keyframes"] = sorted(
+            float(packet["pts_time"]) for packet in info.get("packets", [])
+            if packet.get("stream_index") == video.get("index") and "K" in packet.get("flags", "")
+            and packet.get("pts_time") not in (None, "N/A"))
+    return profile
+
+
+def concat_profile(profile: dict) -> tuple:
+    return tuple(profile.get(key) for key in CONCAT_PROFILE_KEYS)
+
+
+def conform_to_profile(input_path: str, output_path: str, profile: dict, crf: int = 18, threads: int = None) -> str:
+    """Re-encodes input_path so its streams match profile (adding silence if it has no audio)."""
+    source = probe_media(input_path)
+    timescale = profile["time_base"].split("/")[1] if profile.get("time_base") else None
+    command = ["ffmpeg", "-y", "-loglevel", "error", "-i", input_path]
+    if source["audio_codec"] is None:
+        channel_layout = "stereo" if profile["channels"] == 2 else "mono"
+        command += ["-f", "lavfi", "-i", f"anullsrc=channel_layout={channel_layout}:sample_rate={profile['sample_rate']}",
+                    "-shortest"]
+    command += [
+        "-map", "0:v:0", "-map", "1:a:0" if source["audio_codec"] is None else "0:a:0",
+        "-vf", f"scale={profile['width']}:{profile['height']},fps={profile['frame_rate']},format={profile['pix_fmt']}",
+        "-c:v", ENCODERS[profile["video_codec"]], "-crf", str(crf),
+        "-c:a", ENCODERS[profile["audio_codec"]], "-ar", str(profile["sample_rate"]), "-ac", str(profile["channels"]),
+    ]
+    if timescale:
+        command += ["-video_track_timescale", timescale]
+    if threads:
+        command += ["-threads", str(threads)]
+    command.append(output_path)
+    run_ffmpeg(command, check=True)
+    return output_path
+
+
+def concat_segments(segment_paths: list, output_path: str, work_dir: str = None, crf: int = 18) -> str:
+    """
+    Joins segments with the concat demuxer and -c copy.
+
+    Every segment is probed first; the profile shared by most segments (if
+    its codecs can be encoded here) becomes the target and only segments that
+    differ from it are re-encoded to match before the stream copy.
+    """
+    if not segment_paths:
+        raise ValueError("No segments to concatenate")
+    work_dir = work_dir or os.path.dirname(os.path.abspath(output_path))
+    os.makedirs(work_dir, exist_ok=True)
+
+    profiles = [probe_media(path) for path in segment_paths]
+    counts = Counter(concat_profile(p) for p in profiles)
+    target = next((p for key, _ in counts.most_common() for p in profiles
+                   if concat_profile(p) == key and p["video_codec"] in ENCODERS and p["audio_codec"] in ENCODERS),
+                  None)
+    if target is None:
+        raise ValueError("No segment has an encodable video and audio profile to conform to")
+
+    inputs = []
+    for index, (path, profile) in enumerate(zip(segment_paths, profiles)):
+        if concat_profile(profile) == concat_profile(target):
+            inputs.append(path)
+            continue
+        conformed = os.path.join(work_dir, f"conformed_{index}_{os.path.basename(path)}")
+        logger.info(f"Re-encoding {path} to match the concat profile")
+        inputs.append(conform_to_profile(path, conformed, target, crf=crf))
+
+    list_path = os.path.join(work_dir, "concat_list.txt")
+    with open(list_path, "w", encoding="utf-8") as f:
+        for path in inputs:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+
+    run_ffmpeg([
+        "ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0",
+        "-i", list_path, "-c", "copy", "-movflags", "+faststart", output_path
+    ], check=True)
+    conformed_count = sum(1 for a, b in zip(inputs, segment_paths) if a != b)
+    logger.info(f"Concatenated {len(inputs)} segments into {output_path} ({conformed_count} re-encoded)")
+    return output_path
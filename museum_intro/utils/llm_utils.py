@@ -0,0 +1,170 @@
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate; CJK text runs close to one token per character."""
+    return max(1, len(text) // 2)
+
+
+class OpenAIChatBackend:
+    """Chat completions through the OpenAI API (the client is created on first use)."""
+
+    def __init__(self, model: str = "gpt-4o"):
+        self.model = model
+        self._client = None
+
+    async def complete(self, messages: list, temperature: float = 0.7) -> str:
+        if self._client is None:
+            from openai import AsyncOpenAI
+            self._client = AsyncOpenAI()
+        response = await self._client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=temperature
+        )
+        return response.choices[0].message.content
+
+
+class LocalStubBackend:
+    """
+    Deterministic offline stand-in for the chat backend: the reply depends
+    only on the messages, so runs are reproducible and need no network.
+    """
+
+    model = "local-stub"
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    async def complete(self, messages: list, temperature: float = 0.7) -> str:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        digest = hashlib.sha256(messages[-1]["content"].encode("utf-8")).hexdigest()[:8]
+        return (f"sketch style keyframe {digest}, line art, simple composition, soft museum lighting\n"
+                f"Negative prompt: blurry, distorted, low quality, text, watermark")
+
+
+def get_prompt_backend(name: str = None):
+    """Backend selected by name or the PROMPT_BACKEND env var ("openai" or "stub")."""
+    name = name or os.environ.get("PROMPT_BACKEND", "openai")
+    if name == "stub":
+        return LocalStubBackend(latency=float(os.environ.get("PROMPT_STUB_LATENCY", "0")))
+    return OpenAIChatBackend()
+
+
+class RateLimiter:
+    """
+    Async limiter for requests per minute and (estimated) tokens per minute.
+
+    The window is guarded by a thread lock that is never held across an
+    await, so one limiter can be shared by coroutines on any number of event
+    loops (e.g. successive PromptPrefetchers) and a loop torn down while a
+    request waits never leaves it locked.
+    """
+
+    def __init__(self, requests_per_minute: int = 60, tokens_per_minute: int = 90_000):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._window = []  # (timestamp, tokens) of requests in the last minute
+        self._lock = threading.Lock()
+
+    def _try_acquire(self, tokens: int) -> float:
+        """Takes a slot and returns 0, or returns the seconds to wait before trying again."""
+        with self._lock:
+            now = time.monotonic()
+            self._window = [(t, n) for t, n in self._window if now - t < 60]
+            used_tokens = sum(n for _, n in self._window)
+            if (len(self._window) < self.requests_per_minute
+                    and (not self._window or used_tokens + tokens <= self.tokens_per_minute)):
+                self._window.append((now, tokens))
+                return 0.0
+            return max(0.05, 60 - (now - self._window[0][0]))
+
+    async def acquire(self, tokens: int):
+        while True:
+            wait = self._try_acquire(tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+async def complete_with_retries(backend, messages: list, temperature: float = 0.7,
+                                limiter: RateLimiter = None,
+                                max_retries: int = 4, base_delay: float = 1.0) -> str:
+    """Calls backend.complete, retrying failures with exponential backoff and full jitter."""
+    tokens = sum(estimate_tokens(m["content"]) for m in messages)
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            await limiter.acquire(tokens)
+        try:
+            return await backend.complete(messages, temperature)
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            delay = random.uniform(0, base_delay * 2 ** attempt)
+            logger.warning(f"Prompt request failed ({e}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+class PromptPrefetcher:
+    """
+    Runs prompt coroutines on a background event loop with bounded
+    concurrency, returning concurrent.futures.Future objects. The caller can
+    render item k while the prompts for k+1, k+2, ... are still in flight.
+
+        with PromptPrefetcher(concurrency=4) as prefetcher:
+            futures = [prefetcher.submit(make_coro(seg)) for seg in segments]
+            for future in futures:
+                render(future.result())
+    """
+
+    def __init__(self, concurrency: int = 4):
+        self.concurrency = concurrency
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._semaphore = asyncio.run_coroutine_threadsafe(self._make_semaphore(), self._loop).result()
+
+    async def _make_semaphore(self):
+        return asyncio.Semaphore(self.concurrency)
+
+    async def _bounded(self, coro):
+        async with self._semaphore:
+            return await coro
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(self._bounded(coro), self._loop)
+
+    def run(self, coro):
+        """Runs one coroutine on the background loop and waits for its result."""
+        return self.submit(coro).result()
+
+    async def _cancel_pending(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self):
+        """Cancels prompts still in flight (e.g. after a render error) and stops the loop."""
+        if self._loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self._cancel_pending(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -0,0 +1,142 @@
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+from render_cache import make_cache_key
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class _FileLock:
+    """Exclusive advisory lock on a sidecar .lock file, shared by threads and processes."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self._fd = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if fcntl is not None:
+            self._fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._thread_lock.release()
+        return False
+
+
+class PromptStore:
+    """
+    Prompt cache backed by one append-only JSONL log with an in-memory index.
+
+    Records are keyed by a hash of every input that shapes the prompt, so an
+    edited segment misses while untouched segments keep hitting. Appends are
+    single fsynced lines under a file lock, so parallel workers can share the
+    log; records appended by other processes are picked up on the next lookup.
+    Once superseded and legacy lines outnumber live records, the log is
+    compacted by rewriting it to a temp file and atomically replacing it.
+
+    Keys are content hashes, so an edited or deleted segment leaves its old
+    record behind rather than a superseded line; call compact(keep=live_keys)
+    at the end of a build to drop every record the script no longer uses.
+    """
+
+    def __init__(self, log_path="prompt_log.jsonl", compact_min_lines: int = 100):
+        self.log_path = Path(log_path)
+        self.lock = _FileLock(self.log_path.with_name(self.log_path.name + ".lock"))
+        self.compact_min_lines = compact_min_lines
+        self._index = {}
+        self._offset = 0
+        self._lines = 0
+        self._inode = None
+        with self.lock:
+            self._refresh()
+
+    @staticmethod
+    def key_for(**inputs) -> str:
+        return make_cache_key(**inputs)
+
+    def _refresh(self):
+        """Reads log lines appended since the last refresh (from any process)."""
+        if not self.log_path.exists():
+            self._index, self._offset, self._lines = {}, 0, 0
+            return
+        stat = self.log_path.stat()
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            # New file or compacted elsewhere (replaced or truncated); reread it from the start
+            self._index, self._offset, self._lines = {}, 0, 0
+            self._inode = stat.st_ino
+        with open(self.log_path, "rb") as f:
+            f.seek(self._offset)
+            while True:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    break  # EOF or a partially written line
+                self._offset = f.tell()
+                self._lines += 1
+                try:
+                    record = json.loads(line.decode("utf-8"))
+                except (UnicodeDecodeError, json.JSONDecodeError):
+                    continue
+                if "key" in record:
+                    self._index[record["key"]] = record
+
+    def get(self, key: str):
+        with self.lock:
+            self._refresh()
+            record = self._index.get(key)
+        return dict(record) if record is not None else None
+
+    def put(self, key: str, record: dict):
+        record = {"key": key, **record}
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.lock:
+            self._refresh()
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._refresh()
+            if self._lines >= self.compact_min_lines and self._lines > 2 * len(self._index):
+                self._compact_locked()
+
+    def compact(self, keep=None):
+        """
+        Rewrites the log with only the latest record per key; when keep is
+        given, records whose key is not in it are dropped as well.
+        """
+        with self.lock:
+            self._refresh()
+            if keep is not None:
+                keep = set(keep)
+                self._index = {key: record for key, record in self._index.items() if key in keep}
+            self._compact_locked()
+
+    def _compact_locked(self):
+        tmp_path = self.log_path.with_name(self.log_path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in self._index.values():
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.log_path)
+        logger.info(f"Compacted {self.log_path} from {self._lines} to {len(self._index)} records")
+        stat = self.log_path.stat()
+        self._offset, self._inode = stat.st_size, stat.st_ino
+        self._lines = len(self._index)
+
+    def __len__(self):
+        return len(self._index)
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+_file_hashes = {}
+
+
+def make_cache_key(**params) -> str:
+    """Returns a stable sha256 hex digest of the given render parameters."""
+    payload = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def hash_file(path) -> str:
+    """sha256 of a file's content, memoized on (path, size, mtime)."""
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key in _file_hashes:
+        return _file_hashes[memo_key]
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    _file_hashes[memo_key] = sha.hexdigest()
+    return _file_hashes[memo_key]
+
+
+def link_or_copy(src: Path, dest: Path):
+    """Hardlinks src to dest, falling back to a copy across filesystems."""
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    if dest.exists() or dest.is_symlink():
+        dest.unlink()
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+class RenderCache:
+    """
+    Content-addressed cache of rendered files with a size cap and LRU eviction.
+
+    Entries live in cache_dir as <key><suffix> and are tracked in index.json
+    with their size and last-use time.
+    """
+
+    def __init__(self, cache_dir="render_cache", max_bytes: int = 20 * 1024 ** 3):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.cache_dir / "index.json"
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._index = self._load_index()
+
+    def _load_index(self) -> dict:
+        if not self.index_path.exists():
+            return {}
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            logger.warning(f"Render cache index at {self.index_path} is unreadable, starting empty.")
+            return {}
+        # Drop entries whose files have gone missing
+        return {key: entry for key, entry in index.items() if (self.cache_dir / entry["file"]).exists()}
+
+    def _save_index(self):
+        tmp_path = self.index_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._index, f, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def _entry_path(self, key: str) -> Path:
+        return self.cache_dir / self._index[key]["file"]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def lookup(self, key: str):
+        """Returns the cached file path for key (marking it recently used), or None on a miss."""
+        if key not in self._index or not self._entry_path(key).exists():
+            self._index.pop(key, None)
+            self.misses += 1
+            return None
+        self._index[key]["last_used"] = time.time()
+        self._save_index()
+        self.hits += 1
+        return self._entry_path(key)
+
+    def fetch(self, key: str, dest_path) -> bool:
+        """Places the cached file for key at dest_path. Returns False on a miss."""
+        cached_path = self.lookup(key)
+        if cached_path is None:
+            return False
+        link_or_copy(cached_path, dest_path)
+        return True
+
+    def store(self, key: str, src_path, metadata: dict = None):
+        """
+        Adds src_path to the cache under key and evicts old entries past the
+        size cap. metadata is kept in the index entry alongside the file.
+        """
+        src_path = Path(src_path)
+        file_name = f"{key}{src_path.suffix}"
+        link_or_copy(src_path, self.cache_dir / file_name)
+        self._index[key] = {
+            "file": file_name,
+            "size": src_path.stat().st_size,
+            "last_used": time.time(),
+            **(metadata or {}),
+        }
+        self._evict(keep=key)
+        self._save_index()
+
+    def _evict(self, keep: str = None):
+        total = self.total_bytes()
+        for key in sorted(self._index, key=lambda k: self._index[k]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self._index[key]["size"]
+            self._entry_path(key).unlink(missing_ok=True)
+            del self._index[key]
+            self.evictions += 1
+            logger.info(f"Evicted render cache entry {key}")
+
+    def total_bytes(self) -> int:
+        return sum(entry["size"] for entry in self._index.values())
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._index),
+            "bytes": self.total_bytes(),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
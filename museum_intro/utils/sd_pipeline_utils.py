@@ -0,0 +1,130 @@
+import hashlib
+import logging
+import os
+import time
+from pathlib import Path
+
+import torch
+from PIL import Image
+
+from render_cache import make_cache_key
+from tracing import resident_memory_mb, span
+
+logger = logging.getLogger(__name__)
+
+# Resident pipelines, keyed by (pipeline class name, model_id, dtype, device)
+_PIPELINES = {}
+
+
+def _pipeline_class(pipeline_cls):
+    """A diffusers pipeline class, given as the class or by name (imported on first use)."""
+    if isinstance(pipeline_cls, str):
+        import diffusers
+        return getattr(diffusers, pipeline_cls)
+    return pipeline_cls
+
+
+def _torch_dtype(torch_dtype):
+    return getattr(torch, torch_dtype) if isinstance(torch_dtype, str) else torch_dtype
+
+
+def get_txt2img_pipeline(pipeline_cls, model_id: str, torch_dtype, device: str = "cpu"):
+    """
+    Loads a txt2img pipeline on first use and keeps it resident. pipeline_cls
+    and torch_dtype may be names ("StableDiffusionPipeline", "float16"), so
+    callers need not import diffusers before a pipeline is actually loaded.
+    """
+    pipeline_cls, torch_dtype = _pipeline_class(pipeline_cls), _torch_dtype(torch_dtype)
+    key = (pipeline_cls.__name__, model_id, str(torch_dtype), device)
+    if key not in _PIPELINES:
+        rss_before = resident_memory_mb()
+        start = time.perf_counter()
+        with span("sd_load", pipeline=pipeline_cls.__name__, model_id=model_id):
+            _PIPELINES[key] = pipeline_cls.from_pretrained(model_id, torch_dtype=torch_dtype).to(device)
+        print(f"Loaded {pipeline_cls.__name__} ({model_id}) in {time.perf_counter() - start:.1f}s, "
+              f"RSS {rss_before:.0f} -> {resident_memory_mb():.0f} MB")
+    return _PIPELINES[key]
+
+
+def get_img2img_pipeline(img2img_cls, txt2img_cls, model_id: str, torch_dtype, device: str = "cpu"):
+    """
+    Builds an img2img pipeline from the components of the resident txt2img
+    pipeline, so the UNet, VAE and text encoders are shared rather than loaded twice.
+    """
+    img2img_cls, torch_dtype = _pipeline_class(img2img_cls), _torch_dtype(torch_dtype)
+    key = (img2img_cls.__name__, model_id, str(torch_dtype), device)
+    if key not in _PIPELINES:
+        txt2img = get_txt2img_pipeline(txt2img_cls, model_id, torch_dtype, device)
+        _PIPELINES[key] = img2img_cls(**txt2img.components)
+        logger.info(f"Built {img2img_cls.__name__} from shared {txt2img.__class__.__name__} components")
+    return _PIPELINES[key]
+
+
+def make_generators(seeds, device: str = "cpu"):
+    """One seeded torch.Generator per image, so each image in a batch is reproducible on its own."""
+    return [torch.Generator(device=device).manual_seed(int(seed)) for seed in seeds]
+
+
+def release_sd_pipelines():
+    """Drops every resident Stable Diffusion pipeline."""
+    _PIPELINES.clear()
+
+
+# On-disk cache of prompt embeddings and reference-image latents
+SD_TENSOR_CACHE_DIR = Path("sd_tensor_cache")
+
+_PROMPT_EMBED_NAMES = {
+    2: ("prompt_embeds", "negative_prompt_embeds"),
+    4: ("prompt_embeds", "negative_prompt_embeds", "pooled_prompt_embeds", "negative_pooled_prompt_embeds"),
+}
+
+
+def _load_cached_tensors(key: str):
+    cache_path = SD_TENSOR_CACHE_DIR / f"{key}.pt"
+    if cache_path.exists():
+        return torch.load(cache_path, map_location="cpu")
+    return None
+
+
+def _save_cached_tensors(key: str, tensors: dict):
+    SD_TENSOR_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    cache_path = SD_TENSOR_CACHE_DIR / f"{key}.pt"
+    tmp_path = cache_path.with_suffix(".pt.tmp")
+    torch.save(tensors, tmp_path)
+    os.replace(tmp_path, cache_path)
+
+
+def get_prompt_embeds(pipe, model_id: str, prompt: str, negative_prompt: str = "") -> dict:
+    """
+    Returns the pipeline's prompt embedding kwargs (prompt_embeds, ...) for
+    prompt/negative_prompt, running the text encoder only on a cache miss.
+    """
+    key = make_cache_key(kind="prompt_embeds", model_id=model_id, prompt=prompt, negative_prompt=negative_prompt or "")
+    embeds = _load_cached_tensors(key)
+    if embeds is None:
+        with torch.no_grad():
+            outputs = pipe.encode_prompt(prompt=prompt, device=pipe.device, num_images_per_prompt=1,
+                                         do_classifier_free_guidance=True, negative_prompt=negative_prompt or None)
+        embeds = {name: tensor.cpu() for name, tensor in zip(_PROMPT_EMBED_NAMES[len(outputs)], outputs)}
+        _save_cached_tensors(key, embeds)
+    return {name: tensor.to(pipe.device, dtype=pipe.dtype) for name, tensor in embeds.items()}
+
+
+def get_reference_latents(pipe, model_id: str, image_path: str, resolution) -> torch.Tensor:
+    """
+    Returns VAE latents (already scaled) of a reference image resized to
+    resolution, keyed by the asset's content hash. Img2img pipelines accept
+    these in place of the image and skip the VAE encoder.
+    """
+    with open(image_path, "rb") as f:
+        asset_hash = hashlib.sha256(f.read()).hexdigest()
+    key = make_cache_key(kind="reference_latents", model_id=model_id, asset=asset_hash, resolution=tuple(resolution))
+    cached = _load_cached_tensors(key)
+    if cached is None:
+        image = Image.open(image_path).convert("RGB").resize(tuple(resolution))
+        pixels = pipe.image_processor.preprocess(image).to(pipe.device, dtype=pipe.vae.dtype)
+        with torch.no_grad():
+            latents = pipe.vae.encode(pixels).latent_dist.mode() * pipe.vae.config.scaling_factor
+        cached = {"latents": latents.cpu()}
+        _save_cached_tensors(key, cached)
+    return cached["latents"].to(pipe.device, dtype=pipe.dtype)
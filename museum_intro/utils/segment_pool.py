@@ -0,0 +1,79 @@
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+
+class SegmentRenderError(RuntimeError):
+    """Raised when some segment jobs failed; .errors maps job index to exception, .results holds the rest."""
+
+    def __init__(self, errors: dict, results: list):
+        self.errors = errors
+        self.results = results
+        super().__init__(f"{len(errors)} of {len(results)} segment(s) failed to render: "
+                         f"{', '.join(str(index) for index in sorted(errors))}")
+
+
+def split_cpu_budget(cpu_budget: int = None, num_jobs: int = None, threads_per_job: int = 4) -> tuple:
+    """
+    Splits a CPU budget into (concurrent jobs, ffmpeg threads per job).
+
+    libx264 stops scaling well past a handful of threads per encode, so the
+    budget is spent on more concurrent segments with threads_per_job threads
+    each; when there are fewer jobs than slots the spare cores go to the
+    jobs that do run.
+    """
+    cpu_budget = max(1, cpu_budget or os.cpu_count() or 1)
+    workers = max(1, cpu_budget // max(1, threads_per_job))
+    if num_jobs:
+        workers = min(workers, num_jobs)
+    return workers, max(1, cpu_budget // workers)
+
+
+def _run_job(fn, args, kwargs, threads):
+    start = time.perf_counter()
+    with span(f"segment_job.{fn.__name__}", threads=threads):
+        result = fn(*args, threads=threads, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def render_segments(jobs: list, cpu_budget: int = None, threads_per_job: int = 4) -> list:
+    """
+    Runs segment encode jobs in a process pool within a global CPU budget.
+
+    Each job is (fn, args, kwargs); fn must be importable from a fresh
+    process and accept a threads keyword, which is passed on to ffmpeg as
+    -threads so concurrent encodes never add up to more than cpu_budget.
+    A failing job does not stop the others. Results are returned in job
+    order; if any job failed, SegmentRenderError is raised after all jobs
+    finished, carrying the successful results.
+    """
+    if not jobs:
+        return []
+    workers, threads = split_cpu_budget(cpu_budget, len(jobs), threads_per_job)
+    logger.info(f"Rendering {len(jobs)} segments with {workers} workers x {threads} ffmpeg threads")
+
+    results = [None] * len(jobs)
+    errors = {}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {pool.submit(_run_job, fn, args, kwargs, threads): index
+                   for index, (fn, args, kwargs) in enumerate(jobs)}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                results[index], elapsed = future.result()
+                logger.info(f"Segment job {index} done in {elapsed:.1f}s")
+            except Exception as e:
+                logger.error(f"Segment job {index} failed: {e}")
+                errors[index] = e
+
+    logger.info(f"Rendered {len(jobs) - len(errors)} of {len(jobs)} segments in {time.perf_counter() - start:.1f}s")
+    if errors:
+        raise SegmentRenderError(errors, results)
+    return results
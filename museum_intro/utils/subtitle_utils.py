@@ -1,13 +1,107 @@
+import bisect
+import json
 import logging
 import os
+import re
 from PIL import Image, ImageDraw, ImageFont # Import PIL modules
 from datetime import timedelta 
 import subprocess
 
 import shlex
+import unicodedata
+
+from ffmpeg_utils import probe_media
+from tracing import run_ffmpeg
 
 logger = logging.getLogger(__name__)
 
+# Characters that must not start a line (closing punctuation) or end one (opening brackets)
+NO_LINE_START = set("，。、；：？！）》〉」』】〕〗〙〛”’…—～·%,.;:?!)]}>")
+NO_LINE_END = set("（《〈「『【〔〖〘〚“‘([{<")
+
+# Advance width of every glyph measured so far, per (font file, size)
+_glyph_widths = {}
+
+
+def _font_key(font) -> tuple:
+    return (getattr(font, "path", None) or id(font), getattr(font, "size", None))
+
+
+def _is_wide(char: str) -> bool:
+    """CJK ideographs, kana, Hangul and fullwidth forms: text that can break between any two characters."""
+    return unicodedata.east_asian_width(char) in ("W", "F")
+
+
+def text_width(text: str, font, measure) -> float:
+    """Width of text as the sum of cached per-glyph advances; measure(glyph, font) runs once per new glyph."""
+    widths = _glyph_widths.setdefault(_font_key(font), {})
+    total = 0.0
+    for char in text:
+        width = widths.get(char)
+        if width is None:
+            width = widths[char] = measure(char, font)
+        total += width
+    return total
+
+
+def _wrap_tokens(text: str):
+    """
+    Splits text into break opportunities: each wide character is its own
+    token, other runs of non-space characters are words. Yields
+    (token, preceded_by_space).
+    """
+    word, space_before, pending_space = "", False, False
+    for char in text:
+        if char.isspace():
+            if word:
+                yield word, space_before
+                word = ""
+            pending_space = True
+        elif _is_wide(char) or (char in NO_LINE_START and not word) or (word and _is_wide(word[-1])):
+            if word:
+                yield word, space_before
+            word, space_before, pending_space = char, pending_space, False
+        else:
+            if not word:
+                space_before, pending_space = pending_space, False
+            word += char
+    if word:
+        yield word, space_before
+
+
+def wrap_subtitle_text(text: str, font, max_width: float, measure) -> list:
+    """
+    Greedy line wrapping in linear time.
+
+    Widths are summed incrementally from cached glyph advances instead of
+    re-measuring the whole candidate line for every word. CJK text breaks
+    between characters; closing punctuation is kept on the line before it
+    (hanging past max_width if needed) and opening brackets move to the
+    next line, so no line starts with "，" or ends with "《".
+    """
+    space_width = text_width(" ", font, measure)
+    lines = []
+    current, current_width = [], 0.0  # [(token, preceded_by_space, width)]
+
+    for token, space_before in _wrap_tokens(text):
+        width = text_width(token, font, measure)
+        gap = space_width if space_before and current else 0.0
+        if current and current_width + gap + width > max_width and token[0] not in NO_LINE_START:
+            carry = []
+            while len(current) > 1 and current[-1][0][-1] in NO_LINE_END:
+                carry.insert(0, current.pop())
+            lines.append(current)
+            current = carry
+            current_width = sum(w for _, _, w in carry) + sum(space_width for _, sb, _ in carry[1:] if sb)
+            gap = space_width if space_before and current else 0.0
+        current.append((token, space_before, width))
+        current_width += gap + width
+    if current:
+        lines.append(current)
+
+    return ["".join((" " if space_before and index else "") + token
+                    for index, (token, space_before, _) in enumerate(line)) for line in lines]
+
 def format_ass_timestamp(seconds: float) -> str:
     """Formats a float timestamp (in seconds) to ASS time format (H:MM:SS.cc)."""
     total_milliseconds = int(seconds * 1000)
@@ -28,8 +122,233 @@ def format_srt_timestamp(seconds: float) -> str:
     return f"{int(hours):02}:{int(minutes):02}:{int(seconds):02},{int(milliseconds*1000):03}"
 
 
+def format_vtt_timestamp(seconds: float) -> str:
+    """Formats a float timestamp (in seconds) to WebVTT time format (HH:MM:SS.mmm)."""
+    total_milliseconds = int(round(seconds * 1000))
+    hours, total_milliseconds = divmod(total_milliseconds, 3_600_000)
+    minutes, total_milliseconds = divmod(total_milliseconds, 60_000)
+    seconds, milliseconds = divmod(total_milliseconds, 1_000)
+    return f"{hours:02}:{minutes:02}:{seconds:02}.{milliseconds:03}"
+
+
+_SCALAR_END = re.compile(r"[\s,\]]")
+
+
+def iter_json_cues(json_path: str, chunk_size: int = 1 << 16):
+    """
+    Yields the objects of a top-level JSON array one at a time, reading the
+    file in chunks, so hour-long transcripts never have to be loaded whole.
+    """
+    decoder = json.JSONDecoder()
+    with open(json_path, "r", encoding="utf-8") as f:
+        buffer, started = "", False
+        while True:
+            chunk = f.read(chunk_size)
+            buffer += chunk
+            position = 0
+            while True:
+                while position < len(buffer) and buffer[position] in " \t\r\n,":
+                    position += 1
+                if not started:
+                    if position == len(buffer):
+                        break
+                    if buffer[position] != "[":
+                        raise json.JSONDecodeError("Expected a JSON array of cues", buffer, position)
+                    started = True
+                    position += 1
+                    continue
+                if position == len(buffer):
+                    break
+                if buffer[position] == "]":
+                    return
+                if buffer[position] not in '{["':
+                    # Numbers and literals are not self-delimiting ("12" + "345"); wait for their delimiter
+                    delimiter = _SCALAR_END.search(buffer, position)
+                    if delimiter is None and chunk:
+                        break
+                    end = delimiter.start() if delimiter else len(buffer)
+                    yield decoder.decode(buffer[position:end])
+                    position = end
+                    continue
+                try:
+                    cue, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if not chunk:
+                        raise
+                    break  # object continues in the next chunk
+                yield cue
+                position = end
+            buffer = buffer[position:]
+            if not chunk:
+                if started or buffer.strip():
+                    raise json.JSONDecodeError("Unterminated JSON array", buffer, 0)
+                return
+
+
+def _hex_to_ass_bgr(hex_color: str) -> str:
+    hex_color = hex_color.lstrip('#')
+    r, g, b = int(hex_color[0:2], 16), int(hex_color[2:4], 16), int(hex_color[4:6], 16)
+    return f"&H{b:02X}{g:02X}{r:02X}&"
+
+
+def _cue_fields(cue):
+    """(start, end, text) from a (start, end, text) tuple or a segment dict ("original" or "text")."""
+    if isinstance(cue, dict):
+        return cue.get("start", 0.0), cue.get("end", 0.0), cue.get("original") or cue.get("text", "")
+    return cue
+
+
+class SubtitleWriter:
+    """
+    Writes cues to any of ASS, SRT and WebVTT in a single pass.
+
+    Cues are written as they arrive, so memory stays constant no matter how
+    long the transcript is. With append=True cues are added to existing
+    files: headers are not repeated and SRT numbering continues, which lets
+    incremental rebuilds add only new cues.
+
+        with SubtitleWriter(1280, 720, font_path, ass_path="out.ass", vtt_path="out.vtt") as writer:
+            for cue in iter_json_cues("transcript.json"):
+                writer.write_cue(cue)
+    """
+
+    def __init__(self, video_width: int, video_height: int, font_path: str,
+                 ass_path: str = None, srt_path: str = None, vtt_path: str = None,
+                 font_color: str = "#FFFF00",
+                 font_name: str = "Noto Sans SC",
+                 outline_color: str = "#000000",
+                 opacity: float = 0.9,
+                 margin_bottom_percent: float = 0.05,
+                 append: bool = False):
+        self.video_width = video_width
+        self.video_height = video_height
+        self.paths = {"ass": ass_path, "srt": srt_path, "vtt": vtt_path}
+        self.append = append
+        self.cues_written = 0
+        self._files = {}
+
+        # --- ASS Specific Styling Calculations ---
+        self.font_name = font_name
+        self.ass_font_color = _hex_to_ass_bgr(font_color)
+        self.ass_outline_color = _hex_to_ass_bgr(outline_color)
+        self.ass_opacity = int((1.0 - opacity) * 255)
+
+        base_font_size = video_height // 22
+        if (video_width / video_height) > 16/9:
+            self.font_size = int(base_font_size * 0.8)
+        elif (video_width / video_height) < 9/16:
+            self.font_size = int(base_font_size * 1.2)
+        else:
+            self.font_size = int(base_font_size)
+
+        self._draw = ImageDraw.Draw(Image.new("RGBA", (video_width, 1), (0, 0, 0, 0)))
+        if hasattr(self._draw, "textlength"):
+            self.measure = lambda txt, fnt: self._draw.textlength(txt, font=fnt)
+        else:
+            self.measure = lambda txt, fnt: self._draw.textsize(txt, font=fnt)[0]
+
+        try:
+            self.font = ImageFont.truetype(font_path, self.font_size)
+        except IOError:
+            logger.error(f"❌ Font file not found or invalid: {font_path}. Using default font for ASS.")
+            self.font = ImageFont.load_default()
+            self.font_size = 24
+            self.outline_width = 1
+        else:
+            self.outline_width = max(1, int(self.font_size * 0.05))
+
+        self.margin_v = int(video_height * margin_bottom_percent)
+        self.wrap_width = int(video_width * 0.8) - (self.outline_width * 4)
+
+    def open(self):
+        for fmt, path in self.paths.items():
+            if not path:
+                continue
+            existing = self.append and os.path.exists(path) and os.path.getsize(path) > 0
+            if fmt == "srt" and existing:
+                # Continue numbering after the cues already in the file
+                with open(path, "r", encoding="utf-8") as f:
+                    self.cues_written = sum(1 for line in f if "-->" in line)
+            self._files[fmt] = open(path, "a" if existing else "w", encoding="utf-8")
+            if not existing:
+                self._write_header(fmt, self._files[fmt])
+        return self
+
+    def _write_header(self, fmt: str, f):
+        if fmt == "vtt":
+            f.write("WEBVTT\n\n")
+        elif fmt == "ass":
+            # --- Write ASS Header and Style ---
+            f.write("[Script Info]\n")
+            f.write("ScriptType: v4.00+\n")
+            f.write("PlayResX: {}\n".format(self.video_width))
+            f.write("PlayResY: {}\n".format(self.video_height))
+            f.write("ScaledBorderAndShadow: yes\n")
+            f.write("\n")
+            f.write("[V4+ Styles]\n")
+            f.write(
+                f"Style: Default,{self.font_name},{self.font_size},"
+                f"{self.ass_font_color},{self.ass_font_color},"
+                f"{self.ass_outline_color},{self.ass_outline_color},"
+                f"0,0,0,0,100,100,0,0,1,{self.outline_width},0,"
+                f"2,{int(self.video_width*0.05)},{int(self.video_width*0.05)},{self.margin_v},1\n"
+            )
+            f.write("\n")
+            f.write("[Events]\n")
+            f.write("Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n")
+
+    def write(self, start_time: float, end_time: float, text: str):
+        """Writes one cue to every open format; empty cues are skipped."""
+        if not text:
+            return
+        if "ass" in self._files:
+            lines_for_ass = wrap_subtitle_text(text.replace('\\N', ' '), self.font, self.wrap_width, self.measure)
+            formatted_ass_text = "\\N".join(lines_for_ass)
+            self._files["ass"].write(
+                f"Dialogue: 0,"
+                f"{format_ass_timestamp(start_time)},"
+                f"{format_ass_timestamp(end_time)},"
+                f"Default,,"
+                f"0,0,0,,"
+                f"{{\\alpha&H{self.ass_opacity:02X}&}}{formatted_ass_text}\n"
+            )
+        self.cues_written += 1
+        if "srt" in self._files:
+            self._files["srt"].write(
+                f"{self.cues_written}\n"
+                f"{format_srt_timestamp(start_time)} --> {format_srt_timestamp(end_time)}\n"
+                f"{text}\n\n"
+            )
+        if "vtt" in self._files:
+            self._files["vtt"].write(
+                f"{format_vtt_timestamp(start_time)} --> {format_vtt_timestamp(end_time)}\n"
+                f"{text}\n\n"
+            )
+
+    def write_cue(self, cue):
+        self.write(*_cue_fields(cue))
+
+    def write_cues(self, cues) -> int:
+        """Writes every cue of an iterable (list, generator, iter_json_cues, ...); returns the cue count."""
+        for cue in cues:
+            self.write_cue(cue)
+        return self.cues_written
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
 def generate_srt_ass_file(
-    segments: list,
+    segments,
     srt_output_path: str, # Explicit SRT output path
     ass_output_path: str, # Explicit ASS output path
     video_width: int,
@@ -39,144 +358,94 @@ def generate_srt_ass_file(
     font_name: str = "Noto Sans SC",
     outline_color: str = "#000000",
     opacity: float = 0.9,
-    margin_bottom_percent: float = 0.05
+    margin_bottom_percent: float = 0.05,
+    vtt_output_path: str = None,
+    append: bool = False
 ) -> None:
     """
-    Generates both ASS and SRT subtitle files from a list of segment dictionaries,
-    applying styling and positioning logic for ASS.
-    """
-    # --- ASS Specific Styling Calculations ---
-    def hex_to_ass_bgr(hex_color):
-        hex_color = hex_color.lstrip('#')
-        r, g, b = int(hex_color[0:2], 16), int(hex_color[2:4], 16), int(hex_color[4:6], 16)
-        return f"&H{b:02X}{g:02X}{r:02X}&"
-
-    ass_font_color = hex_to_ass_bgr(font_color)
-    ass_outline_color = hex_to_ass_bgr(outline_color)
-    ass_opacity = int((1.0 - opacity) * 255)
-
-    base_font_size = video_height // 22
-    if (video_width / video_height) > 16/9:
-        subtitle_font_size = int(base_font_size * 0.8)
-    elif (video_width / video_height) < 9/16:
-        subtitle_font_size = int(base_font_size * 1.2)
-    else:
-        subtitle_font_size = int(base_font_size)
-
-    dummy_img = Image.new("RGBA", (video_width, 1), (0, 0, 0, 0))
-    draw_temp = ImageDraw.Draw(dummy_img)
-    try:
-        _ = draw_temp.textlength
-        text_width_func = lambda txt, fnt: draw_temp.textlength(txt, font=fnt)
-    except AttributeError:
-        text_width_func = lambda txt, fnt: draw_temp.textsize(txt, font=fnt)[0]
-
-    try:
-        font = ImageFont.truetype(font_path, subtitle_font_size)
-    except IOError:
-        logger.error(f"❌ Font file not found or invalid: {font_path}. Using default font for ASS.")
-        font = ImageFont.load_default()
-        subtitle_font_size = 24
-        outline_width = 1
-    else:
-        outline_width = max(1, int(subtitle_font_size * 0.05))
-
-    margin_v = int(video_height * margin_bottom_percent)
-
+    Generates ASS and SRT (and optionally WebVTT) subtitle files from segment
+    dictionaries, applying styling and positioning logic for ASS. segments can
+    be any iterable, e.g. iter_json_cues(path), and is consumed in one pass.
+    """
     try:
-        with open(ass_output_path, "w", encoding="utf-8") as ass_f, \
-             open(srt_output_path, "w", encoding="utf-8") as srt_f:
-
-            # --- Write ASS Header and Style ---
-            ass_f.write("[Script Info]\n")
-            ass_f.write("ScriptType: v4.00+\n")
-            ass_f.write("PlayResX: {}\n".format(video_width))
-            ass_f.write("PlayResY: {}\n".format(video_height))
-            ass_f.write("ScaledBorderAndShadow: yes\n")
-            ass_f.write("\n")
-            ass_f.write("[V4+ Styles]\n")
-            ass_f.write(
-                f"Style: Default,{font_name},{subtitle_font_size},"
-                f"{ass_font_color},{ass_font_color},"
-                f"{ass_outline_color},{ass_outline_color},"
-                f"0,0,0,0,100,100,0,0,1,{outline_width},0,"
-                f"2,{int(video_width*0.05)},{int(video_width*0.05)},{margin_v},1\n"
-            )
-            ass_f.write("\n")
-            ass_f.write("[Events]\n")
-            ass_f.write("Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n")
-
-            # --- Iterate Segments for both ASS and SRT ---
-            for i, segment in enumerate(segments):
-                start_time = segment.get("start", 0.0)
-                end_time = segment.get("end", 0.0)
-
-                ass_display_text = segment.get("original", "")
-                srt_display_text = segment.get("original", "")
-
-                if not ass_display_text and not srt_display_text:
-                    continue
-
-                # --- Write to ASS File ---
-                subtitle_width_for_wrap = int(video_width * 0.8)
-                lines_for_ass = []
-                current_line = ""
-                words = ass_display_text.replace('\\N', ' ').split()
-
-                for word in words:
-                    test_line = f"{current_line} {word}".strip()
-                    if current_line == "":
-                        test_line = word
-
-                    if text_width_func(test_line, font) <= subtitle_width_for_wrap - (outline_width * 4):
-                        current_line = test_line
-                    else:
-                        lines_for_ass.append(current_line)
-                        current_line = word
-                lines_for_ass.append(current_line)
-                formatted_ass_text = "\\N".join(lines_for_ass)
-
-                ass_f.write(
-                    f"Dialogue: 0,"
-                    f"{format_ass_timestamp(start_time)},"
-                    f"{format_ass_timestamp(end_time)},"
-                    f"Default,,"
-                    f"0,0,0,,"
-                    f"{{\\alpha&H{ass_opacity:02X}&}}{formatted_ass_text}\n"
-                )
-
-                # --- Write to SRT File ---
-                srt_f.write(f"{i + 1}\n")
-                srt_f.write(f"{format_srt_timestamp(start_time)} --> {format_srt_timestamp(end_time)}\n")
-                srt_f.write(f"{srt_display_text}\n")
-                srt_f.write("\n")
+        with SubtitleWriter(video_width, video_height, font_path,
+                            ass_path=ass_output_path, srt_path=srt_output_path, vtt_path=vtt_output_path,
+                            font_color=font_color, font_name=font_name, outline_color=outline_color,
+                            opacity=opacity, margin_bottom_percent=margin_bottom_percent,
+                            append=append) as writer:
+            writer.write_cues(segments)
 
         logger.info(f"ASS file generated successfully at {ass_output_path}")
         logger.info(f"SRT file generated successfully at {srt_output_path}")
+        if vtt_output_path:
+            logger.info(f"WebVTT file generated successfully at {vtt_output_path}")
 
     except Exception as e:
         logger.error(f"Error generating subtitle files: {e}", exc_info=True)
         raise
 
-def burn_in_subtitles(video_path: str, subtitle_file_path: str, output_path: str, font_path: str):
-    """Burns subtitles into a video using ffmpeg and a custom font."""
+def strip_speaker(line: str) -> str:
+    """Drops a leading "speaker:" label from a narration line, as parse_narration does for TTS."""
+    match = re.match(r"(.+?)[:：](.*)", line)
+    return match.group(2).strip() if match else line.strip()
 
-    if not os.path.exists(font_path):
-        raise FileNotFoundError(f"Font file not found: {font_path}")
+def timed_narration_cues(text: str, duration: float):
+    """
+    Yields (start, end, line) for each line of text without its speaker
+    label, sharing duration in proportion to line length.
+    """
+    lines = [strip_speaker(line) for line in text.splitlines()]
+    lines = [line for line in lines if line]
+    total_chars = sum(len(line) for line in lines) or 1
+    start_time = 0.0
+    for line in lines:
+        end_time = start_time + duration * len(line) / total_chars
+        yield start_time, end_time, line
+        start_time = end_time
+
+def generate_ass(text: str, duration: float, output_path: str, video_width: int, video_height: int,
+                 font_path: str, append: bool = False) -> str:
+    """Writes the ASS file for one narrated segment, timing each narration line by its length."""
+    with SubtitleWriter(video_width, video_height, font_path, ass_path=str(output_path), append=append) as writer:
+        writer.write_cues(timed_narration_cues(text, duration))
+    return output_path
+
+# Quality of burned-in video; smart renders use it too so splice points do not change visibly
+BURN_IN_CRF = 23
+BURN_IN_PRESET = "medium"
 
+def _subtitles_filter(subtitle_file_path: str, font_path: str) -> str:
     font_dir = os.path.dirname(os.path.abspath(font_path))
     font_name = "Noto Sans SC"
-
     # Properly escape paths for ffmpeg
-    subtitles_arg = f"subtitles={shlex.quote(subtitle_file_path)}:fontsdir={shlex.quote(font_dir)}:force_style='Fontname={font_name}'"
+    return f"subtitles={shlex.quote(subtitle_file_path)}:fontsdir={shlex.quote(font_dir)}:force_style='Fontname={font_name}'"
+
+def burn_in_subtitles(video_path: str, subtitle_file_path: str, output_path: str, font_path: str,
+                      smart_render: bool = False):
+    """
+    Burns subtitles into a video using ffmpeg and a custom font.
+    With smart_render only the GOPs that carry subtitles are re-encoded (see smart_burn_in_subtitles).
+    """
+
+    if not os.path.exists(font_path):
+        raise FileNotFoundError(f"Font file not found: {font_path}")
+
+    if smart_render:
+        try:
+            if smart_burn_in_subtitles(video_path, subtitle_file_path, output_path, font_path):
+                return
+        except (subprocess.CalledProcessError, OSError, ValueError) as e:
+            logger.warning(f"Smart subtitle render failed ({e}), re-encoding the whole video")
+
+    subtitles_arg = _subtitles_filter(subtitle_file_path, font_path)
 
     command = [
         "ffmpeg",
         "-i", video_path,
         "-vf", subtitles_arg,
         "-c:v", "libx264",
-        "-preset", "medium",
-        "-crf", "23",
+        "-preset", BURN_IN_PRESET,
+        "-crf", str(BURN_IN_CRF),
         "-c:a", "copy",
         "-y",
         output_path
@@ -186,7 +455,7 @@ def burn_in_subtitles(video_path: str, subtitle_file_path: str, output_path: str
     print(" ".join(command))
 
     try:
-        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        run_ffmpeg(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         print(f"✅ Subtitles burned into: {output_path}")
     except subprocess.CalledProcessError as e:
         print(f"❌ FFmpeg error (code {e.returncode}):\n{e.stderr.decode(errors='ignore')}")
@@ -194,4 +463,155 @@ def burn_in_subtitles(video_path: str, subtitle_file_path: str, output_path: str
     except FileNotFoundError:
         print("❌ FFmpeg not found. Ensure it’s installed and in PATH.")
     except Exception as e:
-        print(f"❌ Unexpected error: {e}")
\ No newline at end of file
+        print(f"❌ Unexpected error: {e}")
+
+
+def parse_ass_timestamp(timestamp: str) -> float:
+    """Parses an ASS timestamp (H:MM:SS.cc) into seconds."""
+    hours, minutes, seconds = timestamp.strip().split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def ass_event_ranges(ass_path: str, merge_gap: float = 0.5) -> list:
+    """
+    Sorted, merged (start, end) ranges in seconds covered by the Dialogue
+    events of an ASS file; ranges closer than merge_gap are joined.
+    """
+    ranges = []
+    with open(ass_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.startswith("Dialogue:"):
+                continue
+            fields = line[len("Dialogue:"):].split(",", 9)
+            if len(fields) < 10 or not fields[9].strip():
+                continue
+            ranges.append((parse_ass_timestamp(fields[1]), parse_ass_timestamp(fields[2])))
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + merge_gap:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+# x264 profile names for the H.264 profiles ffprobe reports
+X264_PROFILES = {"Constrained Baseline": "baseline", "Baseline": "baseline", "Main": "main", "High": "high"}
+
+# Stream parameters that must match between copied and re-encoded pieces: the
+# output MP4 carries a single avcC, so every piece's SPS has to agree with it
+SPLICE_KEYS = ("video_codec", "video_profile", "level", "width", "height", "pix_fmt", "refs", "has_b_frames")
+
+def _x264_args_matching(source: dict) -> list:
+    """libx264 arguments that reproduce the source's profile, level, references and B-frame reordering."""
+    args = ["-profile:v", X264_PROFILES[source["video_profile"]], "-pix_fmt", source["pix_fmt"]]
+    if source.get("level"):
+        args += ["-level:v", f"{source['level'] / 10:g}"]  # ffprobe reports 3.1 as 31
+    if source.get("refs"):
+        args += ["-refs", str(source["refs"])]
+    if not source.get("has_b_frames"):
+        args += ["-bf", "0"]
+    elif source["has_b_frames"] == 1:
+        args += ["-x264-params", "b-pyramid=none"]
+    return args
+
+def plan_smart_render(event_ranges: list, keyframes: list, duration: float) -> list:
+    """
+    Splits [0, duration] into ("copy" | "encode", start, end) pieces: every
+    event range is widened to the enclosing keyframes and re-encoded, the
+    rest is stream-copied. Adjacent encode pieces are merged.
+    """
+    keyframes = sorted(set(keyframes) | {0.0})
+    pieces = []
+    for start, end in event_ranges:
+        start = keyframes[max(0, bisect.bisect_right(keyframes, start) - 1)]
+        next_index = bisect.bisect_right(keyframes, end)
+        end = min(keyframes[next_index], duration) if next_index < len(keyframes) else duration
+        if pieces and start <= pieces[-1][2]:
+            pieces[-1] = ("encode", pieces[-1][1], max(pieces[-1][2], end))
+        else:
+            pieces.append(("encode", start, end))
+
+    plan, position = [], 0.0
+    for _, start, end in pieces:
+        if start > position:
+            plan.append(("copy", position, start))
+        plan.append(("encode", start, end))
+        position = end
+    if position < duration:
+        plan.append(("copy", position, duration))
+    return plan
+
+def smart_burn_in_subtitles(video_path: str, subtitle_file_path: str, output_path: str, font_path: str,
+                            work_dir: str = None, crf: int = BURN_IN_CRF) -> bool:
+    """
+    Burns subtitles by re-encoding only the GOPs that carry a subtitle event.
+
+    The ASS event ranges are widened to keyframe boundaries; those pieces
+    are re-encoded through the subtitles filter with the source's H.264
+    profile, level, pixel format, reference count and B-frame reordering,
+    all other pieces are stream-copied, and the video pieces are joined with
+    the concat demuxer before the original audio is muxed back in untouched.
+    Pieces are written as MPEG-TS so each carries its own in-band parameter
+    sets.
+
+    Returns False (nothing written) when the source cannot be spliced this
+    way, e.g. it is not H.264 or a re-encoded piece does not match the
+    source's SPLICE_KEYS, so the caller can fall back to a full encode.
+    """
+    source = probe_media(video_path, keyframes=True)
+    if (source["video_codec"] != "h264" or source["video_profile"] not in X264_PROFILES
+            or not source["keyframes"]):
+        logger.info(f"{video_path} is not a spliceable H.264 stream, using a full re-encode")
+        return False
+
+    event_ranges = ass_event_ranges(subtitle_file_path)
+    plan = plan_smart_render(event_ranges, source["keyframes"], source["duration"])
+    encoded = sum(end - start for kind, start, end in plan if kind == "encode")
+    logger.info(f"Smart render: re-encoding {encoded:.1f}s of {source['duration']:.1f}s in "
+                f"{sum(1 for kind, _, _ in plan if kind == 'encode')} ranges")
+
+    work_dir = work_dir or os.path.dirname(os.path.abspath(output_path))
+    os.makedirs(work_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(output_path))[0]
+    subtitles_arg = _subtitles_filter(subtitle_file_path, font_path)
+    list_path = os.path.join(work_dir, f"{stem}_pieces.txt")
+    piece_paths = []
+    try:
+        for index, (kind, start, end) in enumerate(plan):
+            piece_path = os.path.join(work_dir, f"{stem}_piece_{index:04d}.ts")
+            piece_paths.append(piece_path)
+            command = ["ffmpeg", "-y", "-loglevel", "error", "-ss", f"{start:.6f}", "-i", video_path,
+                       "-t", f"{end - start:.6f}", "-map", "0:v:0", "-an"]
+            if kind == "copy":
+                command += ["-c:v", "copy", "-bsf:v", "h264_mp4toannexb"]
+            else:
+                # Shift timestamps back to source time so the subtitle filter picks the right events
+                command += ["-vf", f"setpts=PTS+{start:.6f}/TB,{subtitles_arg},setpts=PTS-STARTPTS",
+                            "-c:v", "libx264", "-preset", BURN_IN_PRESET, "-crf", str(crf)]
+                command += _x264_args_matching(source)
+            command += ["-f", "mpegts", piece_path]
+            run_ffmpeg(command, check=True, capture_output=True)
+            if kind == "encode":
+                piece = probe_media(piece_path)
+                mismatched = [key for key in SPLICE_KEYS if piece[key] != source[key]]
+                if mismatched:
+                    logger.info(f"Re-encoded piece differs from {video_path} in {', '.join(mismatched)}, "
+                                f"using a full re-encode")
+                    return False
+
+        with open(list_path, "w", encoding="utf-8") as f:
+            for piece_path in piece_paths:
+                escaped = os.path.abspath(piece_path).replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+        run_ffmpeg([
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "concat", "-safe", "0", "-i", list_path,
+            "-i", video_path,
+            "-map", "0:v:0", "-map", "1:a?",
+            "-c", "copy", "-movflags", "+faststart", output_path
+        ], check=True, capture_output=True)
+    finally:
+        for path in piece_paths + [list_path]:
+            if os.path.exists(path):
+                os.remove(path)
+    print(f"✅ Subtitles burned into: {output_path} (re-encoded {encoded:.1f}s of {source['duration']:.1f}s)")
+    return True
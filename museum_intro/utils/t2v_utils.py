@@ -1,47 +1,405 @@
-import torch
-from diffusers.utils import export_to_video
-from diffusers import AutoencoderKLWan, WanPipeline
-from diffusers.schedulers.scheduling_unipc_multistep import UniPCMultistepScheduler
+import time
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from ffmpeg_utils import FFmpegFrameWriter, segment_writer_kwargs, stream_frames_to_video
+from tracing import span
+
+DEFAULT_MODEL_ID = "Wan-AI/Wan2.1-T2V-1.3B-Diffusers"
+
+DEFAULT_NEGATIVE_PROMPT = ("Bright tones, overexposed, static, blurred details, subtitles, style, works, paintings, "
+                           "images, static, overall gray, worst quality, low quality, JPEG compression residue, ugly, "
+                           "incomplete, extra fingers, poorly drawn hands, poorly drawn faces, deformed, disfigured, "
+                           "misshapen limbs, fused fingers, still picture, messy background, three legs, many people in "
+                           "the background, walking backwards")
+
+# Wan's VAE maps 1 + 4k video frames to 1 + k latent frames
+WAN_TEMPORAL_SCALE = 4
+
+# Resident pipelines, keyed by (model_id, dtype, device, flow_shift)
+_PIPELINES = {}
+
+# torch and diffusers are imported on first use, so the batching helpers (and
+# the benchmark's stand-in models) work without the model packages installed
+if TYPE_CHECKING:
+    import torch
+
+
+def _default_device() -> str:
+    import torch
+    # It's generally recommended to use 'cuda' if available for performance, otherwise 'cpu'
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def get_wan_pipeline(model_id: str = DEFAULT_MODEL_ID,
+                     dtype: "torch.dtype" = None,
+                     device: str = None,
+                     flow_shift: float = 5.0):
+    """
+    Returns a resident WanPipeline for (model_id, dtype, device, flow_shift),
+    loading it on first use only; dtype defaults to bfloat16. Call
+    release_wan_pipeline() to free it.
+    """
+    import torch
+    from diffusers import AutoencoderKLWan, WanPipeline
+    from diffusers.schedulers.scheduling_unipc_multistep import UniPCMultistepScheduler
+
+    dtype = dtype or torch.bfloat16
+    device = device or _default_device()
+    key = (model_id, str(dtype), device, flow_shift)
+    pipe = _PIPELINES.get(key)
+    if pipe is not None:
+        return pipe
+
+    start = time.perf_counter()
+    with span("wan_load", model_id=model_id, device=device):
+        vae = AutoencoderKLWan.from_pretrained(model_id, subfolder="vae", torch_dtype=torch.float32)
+        scheduler = UniPCMultistepScheduler(prediction_type='flow_prediction', use_flow_sigmas=True, num_train_timesteps=1000, flow_shift=flow_shift)
+        pipe = WanPipeline.from_pretrained(model_id, vae=vae, torch_dtype=dtype)
+        pipe.scheduler = scheduler
+        pipe.to(device)
+    print(f"Loaded {model_id} ({dtype}, {device}, flow_shift={flow_shift}) in {time.perf_counter() - start:.1f}s")
+
+    _PIPELINES[key] = pipe
+    return pipe
+
+
+def release_wan_pipeline(model_id: str = None,
+                         dtype: "torch.dtype" = None,
+                         device: str = None,
+                         flow_shift: float = None) -> int:
+    """
+    Drops resident pipelines matching the given fields (all of them when no
+    field is given) and returns how many were released.
+    """
+    released = 0
+    for key in list(_PIPELINES):
+        key_model_id, key_dtype, key_device, key_flow_shift = key
+        if model_id is not None and key_model_id != model_id:
+            continue
+        if dtype is not None and key_dtype != str(dtype):
+            continue
+        if device is not None and key_device != device:
+            continue
+        if flow_shift is not None and key_flow_shift != flow_shift:
+            continue
+        del _PIPELINES[key]
+        released += 1
+
+    if released:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    return released
+
+
+def _clip_writer_kwargs(codec: str, crf: int, audio_path: str = None, subtitle_path: str = None,
+                        duration: float = None) -> dict:
+    """FFmpegFrameWriter kwargs for a clip, or for a finished segment when audio or subtitles are muxed in."""
+    if audio_path or subtitle_path:
+        return segment_writer_kwargs(audio_path, subtitle_path, duration)
+    return {"codec": codec, "crf": crf}
 
-import mediapy as media
 
 def generate_video_clip(prompt: str, duration: float, video_path: str,
                         negative_prompt: str = "",
-                        model_id: str = "Wan-AI/Wan2.1-T2V-1.3B-Diffusers",
+                        model_id: str = DEFAULT_MODEL_ID,
                         height: int = 720,
                         width: int = 1280,
                         fps: int = 16,
                         guidance_scale: float = 5.0,
-                        flow_shift: float = 5.0):
-    vae = AutoencoderKLWan.from_pretrained(model_id, subfolder="vae", torch_dtype=torch.float32)
-    scheduler = UniPCMultistepScheduler(prediction_type='flow_prediction', use_flow_sigmas=True, num_train_timesteps=1000, flow_shift=flow_shift)
-    pipe = WanPipeline.from_pretrained(model_id, vae=vae, torch_dtype=torch.bfloat16)
-    pipe.scheduler = scheduler
-    # It's generally recommended to use 'cuda' if available for performance, otherwise 'cpu'
-    pipe.to("cuda" if torch.cuda.is_available() else "cpu")
+                        flow_shift: float = 5.0,
+                        codec: str = "libx264",
+                        crf: int = 18,
+                        audio_path: str = None,
+                        subtitle_path: str = None,
+                        window_frames: int = None,
+                        overlap_frames: int = 16):
+    """
+    Generates one clip and streams its frames straight into ffmpeg. Passing
+    audio_path/subtitle_path writes the final muxed segment directly, in the
+    shared SEGMENT_PROFILE (codec and crf then do not apply).
+
+    When window_frames is set and the clip is longer than one window, the clip
+    is generated with generate_long_video_clip() instead.
+    """
+    if window_frames and int(duration * fps) > window_frames:
+        return generate_long_video_clip(
+            prompt, duration, video_path,
+            negative_prompt=negative_prompt, model_id=model_id,
+            height=height, width=width, fps=fps,
+            guidance_scale=guidance_scale, flow_shift=flow_shift,
+            codec=codec, crf=crf, audio_path=audio_path, subtitle_path=subtitle_path,
+            window_frames=window_frames, overlap_frames=overlap_frames,
+        )
+
+    load_start = time.perf_counter()
+    pipe = get_wan_pipeline(model_id, flow_shift=flow_shift)
+    load_time = time.perf_counter() - load_start
 
     # Calculate num_frames based on duration and fps
     num_frames = int(duration * fps)
 
     # Apply default negative prompt if the provided one is empty
     if not negative_prompt:
-        negative_prompt = ("Bright tones, overexposed, static, blurred details, subtitles, style, works, paintings, "
-                           "images, static, overall gray, worst quality, low quality, JPEG compression residue, ugly, "
-                           "incomplete, extra fingers, poorly drawn hands, poorly drawn faces, deformed, disfigured, "
-                           "misshapen limbs, fused fingers, still picture, messy background, three legs, many people in "
-                           "the background, walking backwards")
+        negative_prompt = DEFAULT_NEGATIVE_PROMPT
 
     print(f"Generating video for prompt: '{prompt}' with duration {duration}s ({num_frames} frames at {fps} fps)...")
 
-    output = pipe(
-        prompt=prompt,
-        negative_prompt=negative_prompt,
-        height=height,
-        width=width,
-        num_frames=num_frames,
-        guidance_scale=guidance_scale,
-    ).frames[0] # The output of pipe is a list of tensors, we take the first (and usually only) one
-
-    export_to_video(output, video_path, fps=fps)
-    print(f"Video saved to: {video_path}")
-    return video_path
\ No newline at end of file
+    inference_start = time.perf_counter()
+    with span("wan_denoise", frames=num_frames, batch=1):
+        output = pipe(
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            height=height,
+            width=width,
+            num_frames=num_frames,
+            guidance_scale=guidance_scale,
+            output_type="np",
+        ).frames[0] # The output of pipe is a batch of videos, we take the first (and usually only) one
+    inference_time = time.perf_counter() - inference_start
+
+    # Frames are converted to uint8 one at a time while piping into the encoder
+    with span("encode_clip", frames=num_frames):
+        stream_frames_to_video(output, video_path, fps,
+                               **_clip_writer_kwargs(codec, crf, audio_path, subtitle_path, num_frames / fps))
+    del output
+    print(f"Video saved to: {video_path} (load {load_time:.1f}s, inference {inference_time:.1f}s)")
+    return video_path
+
+
+def group_clips_into_batches(clips: list, height: int = 720, width: int = 1280,
+                             fps: int = 16, batch_size: int = 4) -> list:
+    """
+    Groups clip dicts by (height, width, num_frames) and splits each group into
+    batches of up to batch_size clips that can share one pipeline call.
+    """
+    groups = {}
+    for clip in clips:
+        num_frames = int(clip["duration"] * fps)
+        groups.setdefault((clip.get("height", height), clip.get("width", width), num_frames), []).append(clip)
+
+    batches = []
+    for group in groups.values():
+        for start in range(0, len(group), batch_size):
+            batches.append(group[start:start + batch_size])
+    return batches
+
+
+def generate_video_clips_batch(clips: list,
+                               model_id: str = DEFAULT_MODEL_ID,
+                               height: int = 720,
+                               width: int = 1280,
+                               fps: int = 16,
+                               guidance_scale: float = 5.0,
+                               flow_shift: float = 5.0,
+                               batch_size: int = 4,
+                               codec: str = "libx264",
+                               crf: int = 18,
+                               writer_kwargs: dict = None,
+                               window_frames: int = None,
+                               overlap_frames: int = 16):
+    """
+    Generates several clips per WanPipeline forward pass.
+
+    Each clip is a dict with "prompt", "duration" and "video_path", and may set
+    "negative_prompt", "seed", "height" and "width". Clips are grouped by
+    (height, width, num_frames) and each group is run in batches of up to
+    batch_size prompts. Returns the video paths in input order.
+
+    writer_kwargs override the FFmpegFrameWriter settings (e.g.
+    LOSSLESS_CLIP_PROFILE for clips that are encoded again later).
+
+    When window_frames is set, clips longer than one window are generated one
+    at a time with generate_long_video_clip() instead of in a batch.
+    """
+    writer_kwargs = dict({"codec": codec, "crf": crf}, **(writer_kwargs or {}))
+
+    long_clips = [clip for clip in clips if window_frames and int(clip["duration"] * fps) > window_frames]
+    for clip in long_clips:
+        generate_long_video_clip(
+            clip["prompt"], clip["duration"], clip["video_path"],
+            negative_prompt=clip.get("negative_prompt", ""), model_id=model_id,
+            height=clip.get("height", height), width=clip.get("width", width), fps=fps,
+            guidance_scale=guidance_scale, flow_shift=flow_shift,
+            window_frames=window_frames, overlap_frames=overlap_frames,
+            seed=clip.get("seed"), writer_kwargs=writer_kwargs,
+        )
+    clips_to_batch = [clip for clip in clips if clip not in long_clips]
+    if not clips_to_batch:
+        return [clip["video_path"] for clip in clips]
+
+    import torch
+
+    pipe = get_wan_pipeline(model_id, flow_shift=flow_shift)
+    device = pipe.device
+
+    for batch in group_clips_into_batches(clips_to_batch, height, width, fps, batch_size):
+        clip_height = batch[0].get("height", height)
+        clip_width = batch[0].get("width", width)
+        num_frames = int(batch[0]["duration"] * fps)
+        generators = []
+        for clip in batch:
+            generator = torch.Generator(device=device)
+            if clip.get("seed") is not None:
+                generator.manual_seed(clip["seed"])
+            else:
+                generator.seed()
+            generators.append(generator)
+
+        print(f"Generating {len(batch)} videos at {clip_width}x{clip_height} ({num_frames} frames at {fps} fps)...")
+
+        inference_start = time.perf_counter()
+        with span("wan_denoise", frames=num_frames, batch=len(batch)):
+            videos = pipe(
+                prompt=[clip["prompt"] for clip in batch],
+                negative_prompt=[clip.get("negative_prompt") or DEFAULT_NEGATIVE_PROMPT for clip in batch],
+                height=clip_height,
+                width=clip_width,
+                num_frames=num_frames,
+                guidance_scale=guidance_scale,
+                generator=generators,
+                output_type="np",
+            ).frames
+        inference_time = time.perf_counter() - inference_start
+
+        for clip, frames in zip(batch, videos):
+            with span("encode_clip", frames=num_frames):
+                stream_frames_to_video(frames, clip["video_path"], fps, **writer_kwargs)
+            print(f"Video saved to: {clip['video_path']}")
+        del videos
+        print(f"Batch of {len(batch)} done in {inference_time:.1f}s ({inference_time / len(batch):.1f}s per clip)")
+
+    return [clip["video_path"] for clip in clips]
+
+
+def plan_long_clip_windows(num_frames: int, window_frames: int = 81, overlap_frames: int = 16) -> tuple:
+    """
+    Returns (window_frames, stride, overlap_frames, num_windows) for a long clip.
+
+    window_frames is rounded down to 1 + 4k frames and the stride up to whole
+    latent frames (4 video frames), at least half a window, so the overlap
+    (window_frames - stride) never exceeds (window_frames - 1) // 2 and every
+    middle window still has a body between its two blended seams.
+    """
+    window_frames = max(5, (window_frames - 1) // WAN_TEMPORAL_SCALE * WAN_TEMPORAL_SCALE + 1)
+    stride = max(window_frames - max(0, overlap_frames), (window_frames + 1) // 2)
+    stride = min(-(-stride // WAN_TEMPORAL_SCALE) * WAN_TEMPORAL_SCALE, window_frames - 1)
+    num_windows = 1 + max(0, -(-(num_frames - window_frames) // stride))
+    return window_frames, stride, window_frames - stride, num_windows
+
+
+def _long_clip_noise(pipe, num_latent_frames: int, height: int, width: int, seed: int = None):
+    """
+    Initial noise for a whole long clip in Wan latent space, shape
+    (1, C, num_latent_frames, height / 8, width / 8). Windows take slices of
+    it, so latent frames shared by two windows start from the same noise.
+    """
+    import torch
+
+    generator = torch.Generator(device=pipe.device)
+    if seed is not None:
+        generator.manual_seed(seed)
+    else:
+        generator.seed()
+    shape = (1, pipe.transformer.config.in_channels, num_latent_frames,
+             height // pipe.vae_scale_factor_spatial, width // pipe.vae_scale_factor_spatial)
+    return torch.randn(shape, generator=generator, device=pipe.device, dtype=torch.float32)
+
+
+def generate_long_video_clip(prompt: str, duration: float, video_path: str,
+                             negative_prompt: str = "",
+                             model_id: str = DEFAULT_MODEL_ID,
+                             height: int = 720,
+                             width: int = 1280,
+                             fps: int = 16,
+                             guidance_scale: float = 5.0,
+                             flow_shift: float = 5.0,
+                             codec: str = "libx264",
+                             crf: int = 18,
+                             audio_path: str = None,
+                             subtitle_path: str = None,
+                             window_frames: int = 81,
+                             overlap_frames: int = 16,
+                             seed: int = None,
+                             writer_kwargs: dict = None):
+    """
+    Generates a long clip as overlapping temporal windows.
+
+    The initial noise is drawn once for the whole clip in latent space and
+    every window denoises its own slice of it (noise rescheduling as in
+    FreeNoise), so the frames two windows share start from identical noise
+    and converge to the same content; the remaining differences in the
+    overlap are cross-faded. Finished frames are streamed to ffmpeg as soon
+    as they are final, so only one window plus the pending overlap is kept
+    in memory. The stride is rounded to whole latent frames (4 video frames),
+    see plan_long_clip_windows(). writer_kwargs override the
+    FFmpegFrameWriter settings as in generate_video_clips_batch().
+    """
+    num_frames = int(duration * fps)
+    window_frames, stride, overlap_frames, num_windows = plan_long_clip_windows(num_frames, window_frames,
+                                                                                overlap_frames)
+    negative_prompt = negative_prompt or DEFAULT_NEGATIVE_PROMPT
+
+    load_start = time.perf_counter()
+    pipe = get_wan_pipeline(model_id, flow_shift=flow_shift)
+    load_time = time.perf_counter() - load_start
+
+    window_latents = (window_frames - 1) // WAN_TEMPORAL_SCALE + 1
+    stride_latents = stride // WAN_TEMPORAL_SCALE
+    noise = _long_clip_noise(pipe, (num_windows - 1) * stride_latents + window_latents, height, width, seed)
+
+    print(f"Generating long video for prompt: '{prompt}' with duration {duration}s "
+          f"({num_frames} frames in {num_windows} windows of {window_frames}, overlap {overlap_frames})...")
+
+    # Blend weight of the incoming window for each overlapping frame
+    ramp = (np.arange(1, overlap_frames + 1) / (overlap_frames + 1)).reshape(-1, 1, 1, 1)
+
+    inference_time = 0.0
+    tail = None
+    writer_kwargs = dict(_clip_writer_kwargs(codec, crf, audio_path, subtitle_path, num_frames / fps),
+                         **(writer_kwargs or {}))
+    with FFmpegFrameWriter(video_path, fps, width=width, height=height, **writer_kwargs) as writer:
+
+        def emit(frames):
+            for frame in frames:
+                if writer.frames_written >= num_frames:
+                    return
+                writer.write(frame)
+
+        for window_index in range(num_windows):
+            first_latent = window_index * stride_latents
+
+            inference_start = time.perf_counter()
+            with span("wan_denoise", frames=window_frames, batch=1, window=window_index):
+                window = pipe(
+                    prompt=prompt,
+                    negative_prompt=negative_prompt,
+                    height=height,
+                    width=width,
+                    num_frames=window_frames,
+                    guidance_scale=guidance_scale,
+                    latents=noise[:, :, first_latent:first_latent + window_latents],
+                    output_type="np",
+                ).frames[0]
+            inference_time += time.perf_counter() - inference_start
+
+            if tail is not None and overlap_frames:
+                emit(tail * (1 - ramp) + window[:overlap_frames] * ramp)
+                body = window[overlap_frames:]
+            else:
+                body = window
+
+            if window_index < num_windows - 1 and overlap_frames:
+                emit(body[:-overlap_frames])
+                tail = body[-overlap_frames:].copy()
+            else:
+                emit(body)
+                tail = None
+            del window, body
+            print(f"Window {window_index + 1}/{num_windows} done ({writer.frames_written}/{num_frames} frames written)")
+
+    del noise
+    print(f"Video saved to: {video_path} (load {load_time:.1f}s, inference {inference_time:.1f}s)")
+    return video_path
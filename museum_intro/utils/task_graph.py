@@ -0,0 +1,131 @@
+import contextvars
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+
+class TaskGraphError(RuntimeError):
+    """Raised when one or more tasks failed; .errors maps task name to exception."""
+
+    def __init__(self, errors: dict, skipped: list):
+        self.errors = errors
+        self.skipped = skipped
+        names = ", ".join(errors)
+        super().__init__(f"{len(errors)} task(s) failed ({names}); {len(skipped)} dependent task(s) skipped")
+
+
+class TaskGraph:
+    """
+    Runs callables as a dependency graph over named resource pools.
+
+    Each task belongs to a pool (e.g. "diffusion", "tts", "ffmpeg") whose
+    concurrency is capped by pool_limits; a task starts as soon as all of its
+    dependencies have finished and its pool has a free slot. Independent work
+    in different pools runs concurrently, so wall time approaches the longest
+    dependency chain rather than the sum of all stages.
+
+        graph = TaskGraph({"diffusion": 1, "tts": 1, "ffmpeg": 2})
+        graph.add("video_1", make_video, pool="diffusion")
+        graph.add("audio_1", make_audio, pool="tts")
+        graph.add("mux_1", mux, deps=["video_1", "audio_1"], pool="ffmpeg")
+        results = graph.run()
+    """
+
+    def __init__(self, pool_limits: dict = None, default_limit: int = 1):
+        self.pool_limits = dict(pool_limits or {})
+        self.default_limit = default_limit
+        self.tasks = {}
+        self.timings = {}
+
+    def add(self, name: str, fn, deps=(), pool: str = "default"):
+        if name in self.tasks:
+            raise ValueError(f"Duplicate task name: {name}")
+        self.tasks[name] = {"fn": fn, "deps": list(deps), "pool": pool}
+        return name
+
+    def _check(self):
+        for name, task in self.tasks.items():
+            for dep in task["deps"]:
+                if dep not in self.tasks:
+                    raise ValueError(f"Task {name} depends on unknown task {dep}")
+        # Kahn's algorithm to reject cycles before anything runs
+        remaining = {name: len(task["deps"]) for name, task in self.tasks.items()}
+        ready = [name for name, count in remaining.items() if count == 0]
+        visited = 0
+        while ready:
+            current = ready.pop()
+            visited += 1
+            for name, task in self.tasks.items():
+                if current in task["deps"]:
+                    remaining[name] -= 1
+                    if remaining[name] == 0:
+                        ready.append(name)
+        if visited != len(self.tasks):
+            raise ValueError("Task graph contains a cycle")
+
+    def run(self) -> dict:
+        """Runs every task and returns {name: result}. Raises TaskGraphError on failures."""
+        self._check()
+        pools = {}
+        for task in self.tasks.values():
+            pool = task["pool"]
+            if pool not in pools:
+                pools[pool] = ThreadPoolExecutor(max_workers=self.pool_limits.get(pool, self.default_limit),
+                                                 thread_name_prefix=f"{pool}-pool")
+
+        results, errors, skipped = {}, {}, []
+        waiting = {name: set(task["deps"]) for name, task in self.tasks.items()}
+        running = {}
+
+        def timed(name, pool, fn):
+            start = time.perf_counter()
+            try:
+                with span(f"task.{pool}", task=name):
+                    return fn()
+            finally:
+                self.timings[name] = time.perf_counter() - start
+
+        def submit_ready():
+            for name in [n for n, deps in waiting.items() if not deps]:
+                del waiting[name]
+                task = self.tasks[name]
+                # Run in a copy of the caller's context so task spans nest under the caller's span
+                context = contextvars.copy_context()
+                running[pools[task["pool"]].submit(context.run, timed, name, task["pool"], task["fn"])] = name
+
+        def skip_dependents(failed):
+            for name, deps in list(waiting.items()):
+                if failed in self.tasks[name]["deps"]:
+                    del waiting[name]
+                    skipped.append(name)
+                    skip_dependents(name)
+
+        start = time.perf_counter()
+        try:
+            submit_ready()
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        logger.error(f"Task {name} failed: {e}", exc_info=True)
+                        errors[name] = e
+                        skip_dependents(name)
+                        continue
+                    for deps in waiting.values():
+                        deps.discard(name)
+                submit_ready()
+        finally:
+            for executor in pools.values():
+                executor.shutdown(wait=True)
+
+        logger.info(f"Task graph finished {len(results)} tasks in {time.perf_counter() - start:.1f}s")
+        if errors:
+            raise TaskGraphError(errors, skipped)
+        return results
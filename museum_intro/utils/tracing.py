@@ -0,0 +1,272 @@
+import contextvars
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows: no getrusage
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# The trace file and run id live in the environment so spawned workers
+# (render_segments, TTS pools) append their spans to the same run
+TRACE_PATH_ENV = "MUSEUM_TRACE_PATH"
+TRACE_RUN_ENV = "MUSEUM_TRACE_RUN"
+DEFAULT_TRACE_PATH = "trace.jsonl"
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_write_lock = threading.Lock()
+
+
+def configure_tracing(trace_path: str = DEFAULT_TRACE_PATH, run_id: str = None) -> str:
+    """Starts a traced run writing spans to trace_path; returns the run id."""
+    run_id = run_id or f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+    os.environ[TRACE_PATH_ENV] = str(trace_path)
+    os.environ[TRACE_RUN_ENV] = run_id
+    return run_id
+
+
+def tracing_enabled() -> bool:
+    return TRACE_PATH_ENV in os.environ
+
+
+def _process_cpu_time() -> float:
+    """
+    CPU seconds of this process and its reaped children (ffmpeg, pool workers
+    once shut down), so work a span hands to threads or subprocesses counts.
+    """
+    if resource is None:
+        return time.process_time()
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def resident_memory_mb() -> float:
+    """Current resident set size of this process in MB (peak RSS where /proc is unavailable, 0 on Windows)."""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError, IndexError):
+        if resource is None:
+            return 0.0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is bytes on macOS, kilobytes on Linux
+        return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def _children_max_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+class _RssSampler:
+    """
+    Samples the process RSS on one daemon thread while any traced span is
+    open and raises each open span's peak_rss_mb; the thread exits once the
+    last span closes.
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self._spans = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, span):
+        with self._lock:
+            self._spans.add(span)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="span-rss-sampler", daemon=True)
+                self._thread.start()
+
+    def remove(self, span):
+        with self._lock:
+            self._spans.discard(span)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._spans:
+                    self._thread = None
+                    return
+                spans = list(self._spans)
+            rss = resident_memory_mb()
+            for span in spans:
+                span.observe_rss(rss)
+            time.sleep(self.interval)
+
+
+_rss_sampler = _RssSampler()
+
+
+class Span:
+    """One timed stage; ffmpeg subprocess time of nested calls is added to every open ancestor."""
+
+    def __init__(self, name: str, parent=None, **attrs):
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        self.id = uuid.uuid4().hex[:12]
+        self.ffmpeg_seconds = 0.0
+        self.ffmpeg_calls = 0
+        self.peak_rss_mb = 0.0
+
+    def observe_rss(self, rss_mb: float):
+        self.peak_rss_mb = max(self.peak_rss_mb, rss_mb)
+
+    def add_ffmpeg(self, seconds: float):
+        span = self
+        while span is not None:
+            span.ffmpeg_seconds += seconds
+            span.ffmpeg_calls += 1
+            span = span.parent
+
+
+def _write_record(record: dict):
+    path = os.environ.get(TRACE_PATH_ENV)
+    if not path:
+        return
+    line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+    with _write_lock:
+        # Single short appends, so concurrent writers from worker processes do not interleave
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Times a pipeline stage and appends it to the JSONL trace.
+
+        with span("tts", segment_id=3):
+            synthesize(...)
+
+    Each record has wall and CPU seconds, the RSS of this process at span
+    start and end and its peak while the span was open (sampled every 50 ms,
+    so short spikes can be missed), and the time spent in ffmpeg subprocesses
+    started through run_ffmpeg() while the span was open.
+    children_max_rss_mb is the largest RSS any waited-for child (ffmpeg)
+    reached so far in the process: a high-water mark, not a per-span figure.
+
+    CPU time is process-wide, so spans that overlap in other threads (e.g.
+    task graph pools) also count each other's CPU; per-span figures are exact
+    only for spans that run alone.
+    """
+    parent = _current_span.get()
+    current = Span(name, parent, **attrs)
+    token = _current_span.set(current)
+    start_wall, start_cpu = time.perf_counter(), _process_cpu_time()
+    started_at = time.time()
+    traced = tracing_enabled()
+    if traced:
+        start_rss = resident_memory_mb()
+        current.observe_rss(start_rss)
+        _rss_sampler.add(current)
+    status = "ok"
+    try:
+        yield current
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        _current_span.reset(token)
+        if traced:
+            _rss_sampler.remove(current)
+            end_rss = resident_memory_mb()
+            current.observe_rss(end_rss)
+            _write_record({
+                "run": os.environ.get(TRACE_RUN_ENV),
+                "span": current.id,
+                "parent": parent.id if parent else None,
+                "name": name,
+                "start": started_at,
+                "wall_s": round(time.perf_counter() - start_wall, 4),
+                "cpu_s": round(_process_cpu_time() - start_cpu, 4),
+                "start_rss_mb": round(start_rss, 1),
+                "end_rss_mb": round(end_rss, 1),
+                "peak_rss_mb": round(current.peak_rss_mb, 1),
+                "children_max_rss_mb": round(_children_max_rss_mb(), 1) if resource else None,
+                "ffmpeg_s": round(current.ffmpeg_seconds, 4),
+                "ffmpeg_calls": current.ffmpeg_calls,
+                "pid": os.getpid(),
+                "status": status,
+                **current.attrs,
+            })
+
+
+def record_ffmpeg_time(seconds: float):
+    """Adds ffmpeg subprocess time to the open span (and its ancestors)."""
+    current = _current_span.get()
+    if current is not None:
+        current.add_ffmpeg(seconds)
+
+
+def run_ffmpeg(command: list, **kwargs) -> subprocess.CompletedProcess:
+    """subprocess.run for ffmpeg/ffprobe commands, with the runtime charged to the open span."""
+    start = time.perf_counter()
+    try:
+        return subprocess.run(command, **kwargs)
+    finally:
+        record_ffmpeg_time(time.perf_counter() - start)
+
+
+def load_trace(trace_path: str = None, run_id: str = None) -> list:
+    """Span records of one run (the current one by default)."""
+    trace_path = trace_path or os.environ.get(TRACE_PATH_ENV, DEFAULT_TRACE_PATH)
+    run_id = run_id or os.environ.get(TRACE_RUN_ENV)
+    if not os.path.exists(trace_path):
+        return []
+    records = []
+    with open(trace_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if run_id is None or record.get("run") == run_id:
+                records.append(record)
+    return records
+
+
+def summarize_trace(records: list) -> list:
+    """Aggregates span records by name: count, total/max wall, CPU, ffmpeg time and peak RSS."""
+    rows = {}
+    for record in records:
+        row = rows.setdefault(record["name"], {
+            "name": record["name"], "count": 0, "errors": 0, "wall_s": 0.0, "max_wall_s": 0.0,
+            "cpu_s": 0.0, "ffmpeg_s": 0.0, "ffmpeg_calls": 0, "peak_rss_mb": 0.0,
+        })
+        row["count"] += 1
+        row["errors"] += record.get("status") == "error"
+        row["wall_s"] += record["wall_s"]
+        row["max_wall_s"] = max(row["max_wall_s"], record["wall_s"])
+        row["cpu_s"] += record["cpu_s"]
+        row["ffmpeg_s"] += record.get("ffmpeg_s", 0.0)
+        row["ffmpeg_calls"] += record.get("ffmpeg_calls", 0)
+        row["peak_rss_mb"] = max(row["peak_rss_mb"], record.get("peak_rss_mb") or 0.0)
+    return sorted(rows.values(), key=lambda row: row["wall_s"], reverse=True)
+
+
+def print_trace_summary(trace_path: str = None, run_id: str = None):
+    """Prints the per-stage table of a run, slowest stages first."""
+    rows = summarize_trace(load_trace(trace_path, run_id))
+    if not rows:
+        return
+    print(f"\n⏱️  Trace summary ({os.environ.get(TRACE_RUN_ENV, 'all runs')})")
+    print(f"{'stage':<32} {'count':>5} {'wall s':>9} {'max s':>8} {'cpu s':>9} {'ffmpeg s':>9} {'peak MB':>8}")
+    for row in rows:
+        name = row["name"] if not row["errors"] else f"{row['name']} ({row['errors']} failed)"
+        print(f"{name[:32]:<32} {row['count']:>5} {row['wall_s']:>9.1f} {row['max_wall_s']:>8.1f} "
+              f"{row['cpu_s']:>9.1f} {row['ffmpeg_s']:>9.1f} {row['peak_rss_mb']:>8.0f}")
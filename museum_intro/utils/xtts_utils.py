@@ -1,6 +1,18 @@
 import logging
 import os
 import json
+import re
+import tempfile
+import unicodedata
+from importlib import metadata
+from pathlib import Path
+
+import numpy as np
+import soundfile as sf
+import torch
+
+from render_cache import RenderCache, hash_file, make_cache_key
+from tracing import span
 
 logger = logging.getLogger(__name__)
 
@@ -10,34 +22,260 @@ from TTS.api import TTS # For Coqui XTTS
 tts_model_name = "tts_models/multilingual/multi-dataset/xtts_v2"
 os.environ["COQUI_TTS_LICENSE_ACCEPTED"] = "true"
 
+# On-disk cache of speaker conditioning latents, keyed by speaker WAV content hash
+SPEAKER_LATENT_DIR = Path("speaker_latents")
+
+# Language codes used around the pipeline mapped to XTTS language codes
+XTTS_LANGUAGE_ALIASES = {"cn": "zh-cn", "zh": "zh-cn"}
+
+# Synthesized lines, stored as FLAC with duration metadata in the index
+TTS_CACHE_DIR = Path("tts_cache")
+TTS_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+_xtts_model = None
+_speaker_latents = {}
+_tts_cache = None
+
 def get_xtts_model():
+    """Returns the resident XTTS model, loading it on first use."""
+    global _xtts_model
+    if _xtts_model is not None:
+        return _xtts_model
     try:
         from TTS.api import TTS
-        return TTS(model_name="tts_models/multilingual/multi-dataset/xtts_v2", progress_bar=False)
+        with span("xtts_load", model=tts_model_name):
+            _xtts_model = TTS(model_name=tts_model_name, progress_bar=False)
+            if torch.cuda.is_available():
+                _xtts_model.to("cuda")
+        return _xtts_model
     except json.decoder.JSONDecodeError:
         logger.error("XTTS model config is corrupted. Try clearing the cache at ~/.local/share/tts.")
     except Exception as e:
         logger.error(f"XTTS load error: {e}", exc_info=True)
     return None
 
-def synthesize_xtts_audio(full_text: str, speaker_wav_path: str, output_audio_path: str):
+def release_xtts_model():
+    """Drops the resident XTTS model and the in-memory speaker latents."""
+    global _xtts_model
+    _xtts_model = None
+    _speaker_latents.clear()
+
+def get_tts_cache() -> RenderCache:
+    global _tts_cache
+    if _tts_cache is None:
+        _tts_cache = RenderCache(TTS_CACHE_DIR, max_bytes=TTS_CACHE_MAX_BYTES)
+    return _tts_cache
+
+def _model_version() -> str:
+    try:
+        return f"{tts_model_name}@{metadata.version('coqui-tts')}"
+    except metadata.PackageNotFoundError:
+        return tts_model_name
+
+def normalize_tts_text(text: str) -> str:
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+def tts_cache_key(text: str, speaker_wav_path: str, target_language: str = "zh-cn", speed: float = 1.0) -> str:
+    return make_cache_key(
+        text=normalize_tts_text(text),
+        speaker_wav=hash_file(speaker_wav_path),
+        language=XTTS_LANGUAGE_ALIASES.get(target_language, target_language),
+        speed=speed,
+        model=_model_version(),
+    )
+
+def load_cached_tts(key: str):
+    """Returns (samples, sample_rate) for a cached line without touching the model, or None."""
+    cached_path = get_tts_cache().lookup(key)
+    if cached_path is None:
+        return None
+    samples, sample_rate = sf.read(cached_path, dtype="float32")
+    return samples, sample_rate
+
+def store_cached_tts(key: str, samples: np.ndarray, sample_rate: int):
+    TTS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix=".flac", dir=TTS_CACHE_DIR)
+    os.close(fd)
+    try:
+        sf.write(tmp_path, samples, sample_rate, format="FLAC")
+        get_tts_cache().store(key, tmp_path, metadata={
+            "duration": len(samples) / sample_rate,
+            "sample_rate": sample_rate,
+        })
+    finally:
+        os.remove(tmp_path)
+
+def _speaker_latent_path(speaker_wav_path: str) -> Path:
+    return SPEAKER_LATENT_DIR / f"{hash_file(speaker_wav_path)}.pt"
+
+def get_speaker_latents(speaker_wav_path: str):
     """
-    Generates voiceover using Coqui XTTS model with voice cloning.
-    Removed desired_speed parameter.
+    Returns (gpt_cond_latent, speaker_embedding) for a speaker WAV, computing
+    them at most once per file content and caching them in memory and on disk.
     """
+    wav_hash = hash_file(speaker_wav_path)
+    if wav_hash in _speaker_latents:
+        return _speaker_latents[wav_hash]
+
+    cache_path = _speaker_latent_path(speaker_wav_path)
+    if cache_path.exists():
+        cached = torch.load(cache_path, map_location="cpu")
+        latents = (cached["gpt_cond_latent"], cached["speaker_embedding"])
+    else:
+        coqui_tts_model = get_xtts_model()
+        if coqui_tts_model is None:
+            raise RuntimeError("TTS model not available.")
+        with span("speaker_latents"):
+            gpt_cond_latent, speaker_embedding = coqui_tts_model.synthesizer.tts_model.get_conditioning_latents(
+                audio_path=[speaker_wav_path]
+            )
+        latents = (gpt_cond_latent.cpu(), speaker_embedding.cpu())
+        SPEAKER_LATENT_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(".pt.tmp")
+        torch.save({"gpt_cond_latent": latents[0], "speaker_embedding": latents[1]}, tmp_path)
+        os.replace(tmp_path, cache_path)
+        logger.info(f"Cached speaker latents for {speaker_wav_path} at {cache_path}")
+
+    _speaker_latents[wav_hash] = latents
+    return latents
+
+def preload_speaker_latents(speaker_wav_paths):
+    """Computes (or loads) conditioning latents for every speaker WAV up front."""
+    for speaker_wav_path in speaker_wav_paths:
+        get_speaker_latents(speaker_wav_path)
+
+def synthesize_xtts_samples(full_text: str, speaker_wav_path: str,
+                            target_language: str = "zh-cn",
+                            speed: float = 1.0) -> np.ndarray:
+    """Synthesizes full_text with the cached speaker latents and returns float samples."""
     coqui_tts_model = get_xtts_model()
-    target_language = 'cn'
     if coqui_tts_model is None:
         raise RuntimeError("TTS model not available.")
+    gpt_cond_latent, speaker_embedding = get_speaker_latents(speaker_wav_path)
+    xtts = coqui_tts_model.synthesizer.tts_model
+    language = XTTS_LANGUAGE_ALIASES.get(target_language, target_language)
+
+    chunks = []
+    with span("xtts_synthesize", chars=len(full_text)):
+        for sentence in coqui_tts_model.synthesizer.split_into_sentences(full_text):
+            out = xtts.inference(
+                sentence,
+                language,
+                gpt_cond_latent.to(xtts.device),
+                speaker_embedding.to(xtts.device),
+                speed=speed,
+            )
+            chunks.append(np.asarray(out["wav"], dtype=np.float32))
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.float32)
+
+def synthesize_xtts_audio(full_text: str, speaker_wav_path: str, output_audio_path: str,
+                          target_language: str = "zh-cn", speed: float = 1.0):
+    """
+    Generates voiceover using Coqui XTTS model with voice cloning.
+    The model stays resident and speaker latents are reused across calls.
+    """
     try:
-        coqui_tts_model.tts_to_file(
-            text=full_text,
-            speaker_wav=speaker_wav_path,
-            language=target_language,
-            file_path=output_audio_path,
-            split_sentences=True
-        )
+        key = tts_cache_key(full_text, speaker_wav_path, target_language, speed)
+        cached = load_cached_tts(key)
+        if cached is not None:
+            sf.write(output_audio_path, cached[0], cached[1])
+            logger.info(f"Coqui XTTS voiceover served from cache for {output_audio_path}")
+            return
+        samples = synthesize_xtts_samples(full_text, speaker_wav_path, target_language, speed)
+        sample_rate = get_xtts_model().synthesizer.output_sample_rate
+        sf.write(output_audio_path, samples, sample_rate)
+        store_cached_tts(key, samples, sample_rate)
         logger.info(f"Coqui XTTS voiceover generated successfully for {output_audio_path}")
     except Exception as e:
-        logger.error(f"❌ Coqui XTTS voice cloning failed: {e}. Attempting fallback to OpenAI.", exc_info=True)
+        logger.error(f"❌ Coqui XTTS voice cloning failed: {e}.", exc_info=True)
         raise
+
+def _init_tts_worker(torch_threads: int):
+    torch.set_num_threads(torch_threads)
+    get_xtts_model()
+
+def _synthesize_line_batch(batch):
+    sample_rate = get_xtts_model().synthesizer.output_sample_rate
+    results = []
+    for line in batch:
+        samples = synthesize_xtts_samples(line["text"], line["speaker_wav"],
+                                          line.get("language", "zh-cn"), line.get("speed", 1.0))
+        results.append({
+            **line,
+            "samples": samples,
+            "sample_rate": sample_rate,
+            "duration": len(samples) / sample_rate,
+        })
+    return results
+
+def synthesize_lines_batch(lines: list, batch_size: int = 8,
+                           num_workers: int = 0, torch_threads: int = None) -> list:
+    """
+    Synthesizes many narration lines in one go.
+
+    Each line is a dict with "text" and "speaker_wav", optionally "language"
+    and "speed"; any other keys (e.g. segment_id, line_index) are passed
+    through. Lines are grouped by (speaker_wav, language) so each group reuses
+    one set of speaker latents, and groups are split into batches of up to
+    batch_size lines. With num_workers > 0 batches run in a process pool,
+    each worker keeping its own resident model and using torch_threads threads;
+    the parent process does not load the model in that case.
+
+    Returns one dict per input line, in input order, with "samples" (float32),
+    "sample_rate" and "duration" added.
+    """
+    results = [None] * len(lines)
+    cache_keys = {}
+    for index, line in enumerate(lines):
+        key = tts_cache_key(line["text"], line["speaker_wav"], line.get("language", "zh-cn"), line.get("speed", 1.0))
+        cached = load_cached_tts(key)
+        if cached is not None:
+            samples, sample_rate = cached
+            results[index] = {**line, "samples": samples, "sample_rate": sample_rate,
+                              "duration": len(samples) / sample_rate}
+        else:
+            cache_keys[index] = key
+
+    groups = {}
+    for index in cache_keys:
+        line = lines[index]
+        key = (line["speaker_wav"], XTTS_LANGUAGE_ALIASES.get(line.get("language", "zh-cn"), line.get("language", "zh-cn")))
+        groups.setdefault(key, []).append(index)
+
+    batches = []
+    for (speaker_wav, _), indices in groups.items():
+        for start in range(0, len(indices), batch_size):
+            batches.append(indices[start:start + batch_size])
+
+    if batches and num_workers > 0:
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+
+        torch_threads = torch_threads or max(1, (os.cpu_count() or 1) // num_workers)
+        missing_latents = sorted({speaker_wav for speaker_wav, _ in groups
+                                  if not _speaker_latent_path(speaker_wav).exists()})
+        with ProcessPoolExecutor(max_workers=num_workers,
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_tts_worker,
+                                 initargs=(torch_threads,)) as pool:
+            if missing_latents:
+                # One worker computes the missing latents onto disk before any batch needs them; the
+                # parent never loads a model, so only num_workers models are resident
+                pool.submit(preload_speaker_latents, missing_latents).result()
+            futures = {pool.submit(_synthesize_line_batch, [lines[i] for i in batch]): batch for batch in batches}
+            for future, batch in futures.items():
+                for index, result in zip(batch, future.result()):
+                    results[index] = result
+    elif batches:
+        if torch_threads:
+            torch.set_num_threads(torch_threads)
+        for batch in batches:
+            for index, result in zip(batch, _synthesize_line_batch([lines[i] for i in batch])):
+                results[index] = result
+
+    for index, key in cache_keys.items():
+        store_cached_tts(key, results[index]["samples"], results[index]["sample_rate"])
+
+    logger.info(f"Synthesized {len(cache_keys)} of {len(lines)} lines in {len(batches)} batches "
+                f"({len(lines) - len(cache_keys)} from cache, {sum(r['duration'] for r in results):.1f}s of audio)")
+    return results